@@ -0,0 +1,63 @@
+import time
+
+
+class RelayActuator:
+    # Actuator name -> relay number, in the order the relay boards are wired
+    default_relays = {
+        "pumpin": 1,
+        "pumpout": 2,
+        "mixer1": 3,
+        "mixer2": 4,
+        "mixer3": 5,
+        "area1": 6,
+        "area2": 7,
+        "area3": 8,
+    }
+
+    def __init__(self, controller, relays=None, verify_interval=300, clock=None):
+        """
+        :param clock: Returns seconds for the verify interval,
+            time.monotonic if None.
+        """
+        self.controller = controller
+        self.clock = clock or time.monotonic
+        self.relays = {
+            name: int(relay_num)
+            for name, relay_num in (relays or self.default_relays).items()
+        }
+        self.verify_interval = verify_interval
+
+        # Last state acknowledged by each relay, None while unknown
+        self.shadow = {relay_num: None for relay_num in self.relays.values()}
+        self.last_verify = self.clock()
+
+    def apply(self, states):
+        """
+        Drive the relays towards the requested states, only sending frames
+        for relays whose acknowledged state differs.
+        :param states: A dictionary of actuator name -> bool.
+        :return: The dictionary of relay number -> bool that was sent.
+        """
+        if self.clock() - self.last_verify >= self.verify_interval:
+            self.verify()
+
+        changes = {}
+        for name, state in states.items():
+            relay_num = self.relays.get(name)
+            if relay_num is not None and self.shadow[relay_num] != bool(state):
+                changes[relay_num] = bool(state)
+
+        if changes:
+            results = self.controller.set_relays(changes)
+            for relay_num, state in changes.items():
+                # Unacknowledged writes are retried on the next call
+                self.shadow[relay_num] = state if results.get(relay_num) else None
+        return changes
+
+    def verify(self):
+        """
+        Refresh the shadow state from the boards, so relays that were
+        switched behind our back get corrected by the next apply().
+        """
+        self.last_verify = self.clock()
+        self.shadow.update(self.controller.read_relays(list(self.shadow)))
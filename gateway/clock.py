@@ -0,0 +1,61 @@
+import time
+from datetime import datetime, timedelta
+
+
+class SystemClock:
+    """
+    The real time, see SimulatedClock for replays.
+    """
+
+    def now(self):
+        """
+        :return: The local wall clock time as a datetime.
+        """
+        return datetime.now()
+
+    def time(self):
+        """
+        :return: Seconds since the epoch.
+        """
+        return time.time()
+
+    def monotonic(self):
+        """
+        :return: Seconds for measuring intervals.
+        """
+        return time.monotonic()
+
+
+class SimulatedClock:
+    """
+    A clock that only moves when told to, so a replay can run a day of
+    stages as fast as they execute.
+    """
+
+    def __init__(self, start=None):
+        """
+        :param start: The datetime the simulation starts at, midnight today
+            if None.
+        """
+        if start is None:
+            start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.start = start
+        self.elapsed = 0.0
+
+    def set(self, elapsed):
+        """
+        :param elapsed: Seconds since the start, time never runs backwards.
+        """
+        self.elapsed = max(self.elapsed, elapsed)
+
+    def advance(self, seconds):
+        self.elapsed += seconds
+
+    def now(self):
+        return self.start + timedelta(seconds=self.elapsed)
+
+    def time(self):
+        return self.start.timestamp() + self.elapsed
+
+    def monotonic(self):
+        return self.elapsed
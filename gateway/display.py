@@ -0,0 +1,144 @@
+import sys
+
+
+class PygameDisplay:
+    # Rendered text surfaces kept for reuse, values that repeat (booleans,
+    # levels stepping by 10, task names) are only rendered once
+    cache_limit = 256
+
+    def __init__(self, size=(1200, 680), font_path="DejaVuSans.ttf", font_size=36):
+        # Only windowed gateways pay for loading SDL and the font renderer
+        import pygame
+
+        self.pygame = pygame
+        pygame.init()
+        self.screen = pygame.display.set_mode(size)
+        pygame.display.set_caption("Smart Farm Monitor")
+        self.font = pygame.font.Font(font_path, font_size)
+        self.background_color = (0, 0, 0)
+        self.text_color = (255, 255, 255)
+
+        self.surfaces = {}
+        # Text and screen area of every line currently drawn
+        self.lines = []
+        self.rects = []
+        self.expose_events = {
+            getattr(pygame, name)
+            for name in ("VIDEOEXPOSE", "WINDOWEXPOSED")
+            if hasattr(pygame, name)
+        }
+        self.invalidate()
+
+    def poll(self):
+        """
+        Handle pending window events.
+        :return: False once the window was closed.
+        """
+        running = True
+        for event in self.pygame.event.get():
+            if event.type == self.pygame.QUIT:
+                running = False
+            elif event.type in self.expose_events:
+                self.invalidate()
+        return running
+
+    def invalidate(self):
+        # Redraw everything on the next show()
+        self.screen.fill(self.background_color)
+        self.pygame.display.flip()
+        self.lines = []
+        self.rects = []
+
+    def show(self, lines):
+        """
+        Draw the lines, re-rendering and updating only those that changed.
+        """
+        dirty = []
+        for i, text in enumerate(lines):
+            if i < len(self.lines) and self.lines[i] == text:
+                continue
+            surface = self.text_surface(text)
+            rect = surface.get_rect(topleft=(20, 20 + 50 * i))
+            if i < len(self.rects):
+                area = rect.union(self.rects[i])
+                self.lines[i] = text
+                self.rects[i] = rect
+            else:
+                area = rect
+                self.lines.append(text)
+                self.rects.append(rect)
+            self.screen.fill(self.background_color, area)
+            self.screen.blit(surface, rect)
+            dirty.append(area)
+
+        # Lines that are no longer shown
+        for rect in self.rects[len(lines) :]:
+            self.screen.fill(self.background_color, rect)
+            dirty.append(rect)
+        del self.lines[len(lines) :]
+        del self.rects[len(lines) :]
+
+        if dirty:
+            self.pygame.display.update(dirty)
+
+    def text_surface(self, text):
+        surface = self.surfaces.get(text)
+        if surface is None:
+            if len(self.surfaces) >= self.cache_limit:
+                # Drop the oldest entry
+                del self.surfaces[next(iter(self.surfaces))]
+            surface = self.font.render(text, True, self.text_color)
+            self.surfaces[text] = surface
+        return surface
+
+    def close(self):
+        self.pygame.quit()
+
+
+class TerminalDisplay:
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.last_lines = None
+
+    def poll(self):
+        return True
+
+    def show(self, lines):
+        # Snapshots hand over tuples, a list would never compare equal
+        lines = tuple(lines)
+        if lines == self.last_lines:
+            return
+        self.last_lines = lines
+        # Clear the screen and redraw from the top left corner
+        self.stream.write("\x1b[2J\x1b[H" + "\n".join(lines) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class NullDisplay:
+    def poll(self):
+        return True
+
+    def show(self, lines):
+        pass
+
+    def close(self):
+        pass
+
+
+DISPLAYS = {
+    "pygame": PygameDisplay,
+    "terminal": TerminalDisplay,
+    "none": NullDisplay,
+}
+
+
+def create_display(kind):
+    """
+    :param kind: One of "pygame", "terminal" or "none".
+    """
+    if kind not in DISPLAYS:
+        raise ValueError(f"Unknown display {kind!r}, expected one of {list(DISPLAYS)}")
+    return DISPLAYS[kind]()
@@ -0,0 +1,212 @@
+import argparse
+import json
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+
+from modbus import Modbus485_, SensorRelayController, bus_configs, check_crc, open_buses
+
+
+class ModbusSlaveEmulator:
+    """
+    Modbus RTU slaves behind a pseudo-terminal. Open self.port with
+    serial.Serial like a USB-RS485 adapter and the emulator answers as the
+    relay boards and sensors it was configured with.
+    """
+
+    def __init__(
+        self,
+        slaves,
+        baudrate=9600,
+        latency=0.005,
+        drop_rate=0.0,
+        corrupt_rate=0.0,
+        seed=None,
+    ):
+        """
+        :param slaves: Slave addresses to answer for, others stay silent.
+        :param baudrate: Wire speed used to pace requests and replies.
+        :param latency: Seconds a slave takes to start replying.
+        :param drop_rate: Probability of not answering a request.
+        :param corrupt_rate: Probability of flipping a bit in a reply.
+        :param seed: Seed for the drop and corruption decisions.
+        """
+        self.slaves = set(slaves)
+        self.baudrate = baudrate
+        self.char_time = 11.0 / baudrate
+        self.frame_gap = 3.5 * self.char_time if baudrate <= 19200 else 0.00175
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.random = random.Random(seed)
+
+        # The in-process stub keeps the register map and builds the replies
+        self.model = Modbus485_(None)
+        self.stats = {"requests": 0, "replies": 0, "dropped": 0, "corrupted": 0}
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = False
+        self.thread = None
+
+    @classmethod
+    def from_config(cls, config, bus, **kwargs):
+        """
+        Emulate every slave a SensorRelayController would talk to on a bus.
+        :param config: The "modbus" section of config.json.
+        :param bus: Name of the bus, see modbus.bus_configs.
+        """
+        controller = SensorRelayController({}, config)
+        slaves = {slave for name, slave, _ in controller.relays.values() if name == bus}
+        sensors = list(controller.sensors.values()) + [controller.levels]
+        slaves.update(sensor["slave"] for sensor in sensors if sensor["bus"] == bus)
+        return cls(slaves, **kwargs)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(
+            target=self._run, name="modbus-emulator", daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _run(self):
+        frame = b""
+        while self.running:
+            # A frame ends after 3.5 characters of silence
+            timeout = self.frame_gap if frame else 0.1
+            readable, _, _ = select.select([self.master], [], [], timeout)
+            if readable:
+                frame += os.read(self.master, 256)
+                continue
+            if frame:
+                self._answer(frame)
+                frame = b""
+
+    def _answer(self, frame):
+        self.stats["requests"] += 1
+        reply = self.handle(frame)
+        if reply is None:
+            return
+        if self.random.random() < self.drop_rate:
+            self.stats["dropped"] += 1
+            return
+        if self.random.random() < self.corrupt_rate:
+            self.stats["corrupted"] += 1
+            reply = bytearray(reply)
+            reply[self.random.randrange(len(reply))] ^= 1 << self.random.randrange(8)
+            reply = bytes(reply)
+
+        # The request had to arrive before the slave could start answering
+        time.sleep(self.latency + (len(frame) + len(reply)) * self.char_time)
+        os.write(self.master, reply)
+        self.stats["replies"] += 1
+
+    def handle(self, frame):
+        """
+        Process one request frame like a slave would.
+        :return: The reply frame, or None if the slave stays silent.
+        """
+        if len(frame) < 8 or not check_crc(frame) or frame[0] not in self.slaves:
+            return None
+        return self.model.reply(bytes(frame))
+
+
+def benchmark(config, count):
+    """
+    Run sweep and relay cycles against the buses in config and print
+    latency percentiles and per-slave metrics.
+    """
+    buses = open_buses(config)
+    controller = SensorRelayController(buses, config)
+
+    latencies = []
+    errors = 0
+    start = time.monotonic()
+    for i in range(count):
+        t = time.monotonic()
+        soil = controller.sweep_soil_data()
+        acked = controller.set_relays(
+            {relay: i % 2 == 0 for relay in controller.relays}
+        )
+        latencies.append(time.monotonic() - t)
+        errors += len(controller.sensors) - len(soil)
+        errors += list(acked.values()).count(False)
+    elapsed = time.monotonic() - start
+    for bus in buses.values():
+        bus.close()
+
+    latencies.sort()
+    print(f"{count} cycles in {elapsed:.2f} s, {errors} errors")
+    print(
+        f"Cycle latency: p50={latencies[len(latencies) // 2] * 1000:.1f} ms, "
+        + f"p99={latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms"
+    )
+    for name, bus in buses.items():
+        print(f"{name}:\n{bus.metrics.format()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Modbus RTU slave emulator")
+    parser.add_argument("--baudrate", type=int, default=9600)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--corrupt-rate", type=float, default=0.0)
+    parser.add_argument("--retries", type=int, default=0)
+    parser.add_argument(
+        "--bench", type=int, default=0, help="Run N poll cycles and exit"
+    )
+    args = parser.parse_args()
+
+    with open("config.json", "r") as f:
+        modbus_config = json.load(f).get("modbus", {})
+
+    # One emulated adapter per configured bus
+    emulators = {}
+    for name in bus_configs(modbus_config):
+        emulators[name] = ModbusSlaveEmulator.from_config(
+            modbus_config,
+            name,
+            baudrate=args.baudrate,
+            latency=args.latency,
+            drop_rate=args.drop_rate,
+            corrupt_rate=args.corrupt_rate,
+        ).start()
+        slaves = sorted(emulators[name].slaves)
+        print(f"{name}: slaves {slaves} on {emulators[name].port}")
+
+    try:
+        if args.bench:
+            # Point every bus at its emulator
+            buses = {
+                name: dict(
+                    bus_configs(modbus_config)[name],
+                    port=emulator.port,
+                    baudrate=args.baudrate,
+                    retries=args.retries,
+                )
+                for name, emulator in emulators.items()
+            }
+            benchmark(dict(modbus_config, buses=buses), args.bench)
+            for name, emulator in emulators.items():
+                print(f"{name} emulator:", emulator.stats)
+        else:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for emulator in emulators.values():
+            emulator.stop()
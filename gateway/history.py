@@ -0,0 +1,200 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TIME_FILE = "time.f8"
+
+
+class HistoryStore:
+    """
+    Telemetry history in a fixed size ring buffer, one column per series.
+    Rows are flushed to append-only column files, one raw little endian
+    file per series, so a query only reads the columns and rows it needs.
+    """
+
+    def __init__(self, series, capacity=8640, path=None, readonly=False):
+        """
+        :param series: Series names, e.g. "area1.moisture".
+        :param capacity: Rows kept in memory, rows not flushed by the time
+            they are overwritten are lost.
+        :param path: Directory of the column files, None to keep only
+            what fits in memory.
+        :param readonly: Only query the files, while the gateway may be
+            appending to them.
+        """
+        self.series = list(series)
+        self.columns = {name: i for i, name in enumerate(self.series)}
+        self.capacity = capacity
+        self.times = np.full(capacity, np.nan)
+        self.values = np.full((capacity, len(self.series)), np.nan, "f4")
+        # Rows appended and flushed since the start
+        self.count = 0
+        self.flushed = 0
+        self.lost = 0
+
+        self.path = path
+        if path is not None and not readonly:
+            os.makedirs(path, exist_ok=True)
+            self._align()
+
+    @classmethod
+    def from_config(cls, series, config):
+        """
+        :param config: The "history" section of config.json.
+        """
+        return cls(series, config.get("capacity", 8640), config.get("path"))
+
+    def column_file(self, name):
+        return os.path.join(self.path, name + ".f4")
+
+    def _align(self):
+        # A crash between writing the time and value files, or a series
+        # added to config, leaves columns of different length
+        rows = self._rows(os.path.join(self.path, TIME_FILE), 8)
+        for name in self.series:
+            path = self.column_file(name)
+            length = self._rows(path, 4)
+            if length < rows:
+                with open(path, "ab") as f:
+                    f.write(np.full(rows - length, np.nan, "<f4").tobytes())
+            elif length > rows:
+                with open(path, "r+b") as f:
+                    f.truncate(rows * 4)
+
+    @staticmethod
+    def _rows(path, itemsize):
+        try:
+            return os.path.getsize(path) // itemsize
+        except FileNotFoundError:
+            return 0
+
+    def append(self, row, timestamp=None):
+        """
+        :param row: One value per series, in the order of self.series.
+        :param timestamp: Seconds since the epoch, now if None.
+        """
+        i = self.count % self.capacity
+        self.times[i] = time.time() if timestamp is None else timestamp
+        self.values[i] = row
+        self.count += 1
+
+    def _pending(self):
+        # Ring positions of the rows not flushed yet, oldest first, and the
+        # row count they end at
+        end = self.count
+        start = max(self.flushed, end - self.capacity)
+        return np.arange(start, end) % self.capacity, start - self.flushed, end
+
+    def flush(self):
+        """
+        Append the rows added since the last flush to the column files.
+        """
+        if self.path is None or self.count == self.flushed:
+            return
+        # Rows appended while the files are written are left for the next
+        # flush, append() runs on the control loop meanwhile
+        index, lost, end = self._pending()
+        if lost:
+            self.lost += lost
+            logger.warning(
+                "History lost %d rows, flush more often or grow capacity", lost
+            )
+        with open(os.path.join(self.path, TIME_FILE), "ab") as f:
+            f.write(self.times[index].astype("<f8").tobytes())
+        values = self.values[index]
+        for name, column in self.columns.items():
+            with open(self.column_file(name), "ab") as f:
+                f.write(values[:, column].astype("<f4").tobytes())
+        self.flushed = end
+
+    def load(self, name, start, end):
+        """
+        :return: The times and values of a series with start <= time < end.
+        """
+        times = []
+        values = []
+        if self.path is not None:
+            disk_times = self._map(os.path.join(self.path, TIME_FILE), "<f8")
+            column = self._map(self.column_file(name), "<f4")
+            # The time file is written first, a concurrent flush can leave
+            # the column shorter for a moment
+            disk_times = disk_times[: len(column)]
+            if len(disk_times):
+                lo, hi = np.searchsorted(disk_times, [start, end])
+                times.append(np.array(disk_times[lo:hi]))
+                values.append(np.array(column[lo:hi]))
+
+        # Rows still only in memory, or all of them without a path
+        if self.path is None:
+            first = max(0, self.count - self.capacity)
+            index = np.arange(first, self.count) % self.capacity
+        else:
+            index, _, _ = self._pending()
+        ring_times = self.times[index]
+        selected = (ring_times >= start) & (ring_times < end)
+        times.append(ring_times[selected])
+        values.append(self.values[index, self.columns[name]][selected])
+
+        times = np.concatenate(times)
+        values = np.concatenate(values).astype("f8")
+        # Gaps from sensors that did not answer
+        valid = ~np.isnan(values)
+        return times[valid], values[valid]
+
+    @staticmethod
+    def _map(path, dtype):
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return np.empty(0, dtype)
+        return np.memmap(path, dtype, mode="r")
+
+    def query(self, name, start, end, step):
+        """
+        Downsample a series to one min, max and mean per step seconds.
+        :param name: The series.
+        :param start: Seconds since the epoch.
+        :param end: Seconds since the epoch.
+        :param step: Bucket width in seconds.
+        :return: A dictionary of "time" (bucket starts), "min", "max" and
+            "mean" arrays, buckets without data are left out.
+        """
+        times, values = self.load(name, start, end)
+        if len(times) == 0:
+            empty = np.empty(0)
+            return {"time": empty, "min": empty, "max": empty, "mean": empty}
+        buckets = ((times - start) // step).astype(np.int64)
+        edges = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        counts = np.diff(np.append(edges, len(values)))
+        return {
+            "time": start + buckets[edges] * step,
+            "min": np.minimum.reduceat(values, edges),
+            "max": np.maximum.reduceat(values, edges),
+            "mean": np.add.reduceat(values, edges) / counts,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the telemetry history")
+    parser.add_argument("series", help='e.g. "area1.moisture" or "water"')
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--step", type=float, default=3600, help="Bucket seconds")
+    args = parser.parse_args()
+
+    with open("config.json", "r") as f:
+        config = json.load(f).get("history", {})
+
+    store = HistoryStore(
+        [args.series], path=config.get("path", "history"), readonly=True
+    )
+    end = time.time()
+    result = store.query(args.series, end - args.hours * 3600, end, args.step)
+    for row in zip(*result.values()):
+        print(
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(row[0]))
+            + f"  min={row[1]:g} max={row[2]:g} mean={row[3]:g}"
+        )
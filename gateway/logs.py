@@ -0,0 +1,50 @@
+import logging
+import logging.handlers
+import queue
+
+FORMAT = "%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s"
+
+
+def setup_logging(config):
+    """
+    Send every log record through a queue, so logging from the control
+    loop or a bus thread never waits on the disk or the terminal. A
+    listener thread writes the records to a rotating file and, from the
+    console level up, to stderr.
+    :param config: The "logging" section of config.json.
+    :return: The started QueueListener, stop() it to flush on exit.
+    """
+    formatter = logging.Formatter(FORMAT)
+    handlers = []
+    if config.get("file", "gateway.log"):
+        file_handler = logging.handlers.RotatingFileHandler(
+            config.get("file", "gateway.log"),
+            maxBytes=config.get("max_bytes", 1024 * 1024),
+            backupCount=config.get("backup_count", 5),
+            encoding="utf-8",
+        )
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+    if config.get("console", "WARNING"):
+        console = logging.StreamHandler()
+        console.setLevel(config.get("console", "WARNING"))
+        console.setFormatter(formatter)
+        handlers.append(console)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(config.get("level", "INFO"))
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    # Per module levels, e.g. {"modbus": "DEBUG"} for the raw frames
+    for name, level in config.get("levels", {}).items():
+        logging.getLogger(name).setLevel(level)
+    # Python warnings go to the log instead of stderr
+    logging.captureWarnings(True)
+
+    listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True
+    )
+    listener.start()
+    return listener
@@ -1,13 +1,335 @@
+import bisect
+import functools
+import itertools
+import logging
+import queue
 import random
 import struct
+import threading
 import time
+from concurrent.futures import Future
 
 import serial
 
 
+logger = logging.getLogger(__name__)
+
+UINT16 = struct.Struct(">H")
+UINT16S = [struct.Struct(">%dH" % count) for count in range(126)]
+FLOAT32 = struct.Struct(">f")
+
+
+class ModbusError(Exception):
+    pass
+
+
+class ModbusTimeout(ModbusError):
+    pass
+
+
+class ModbusCRCError(ModbusError):
+    pass
+
+
+class ModbusDeadlineExceeded(ModbusError):
+    pass
+
+
+class ModbusExceptionResponse(ModbusError):
+    def __init__(self, slave, function, code):
+        super().__init__(
+            f"Slave {slave} rejected function {function:#04x} with code {code}"
+        )
+        self.slave = slave
+        self.function = function
+        self.code = code
+
+
+READ_COILS = 0x01
+READ_HOLDING_REGISTERS = 0x03
+WRITE_SINGLE_COIL = 0x05
+WRITE_SINGLE_REGISTER = 0x06
+WRITE_MULTIPLE_COILS = 0x0F
+WRITE_MULTIPLE_REGISTERS = 0x10
+
+# Bus scheduling priorities, lower runs first
+PRIORITY_SAFETY = 0
+PRIORITY_RELAY = 1
+PRIORITY_POLL = 10
+
+RELAY_ON = 0x00FF
+RELAY_OFF = 0x0000
+COIL_ON = 0xFF00
+COIL_OFF = 0x0000
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data):
+    crc = 0xFFFF
+    table = CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+@functools.lru_cache(maxsize=512)
+def build_frame(slave, function, payload=b""):
+    """
+    Encode a Modbus RTU frame. Frames are cached, so repeated requests cost
+    a dictionary lookup instead of a CRC computation.
+    :param slave: Slave address (0-247).
+    :param function: Modbus function code.
+    :param payload: Function specific data as bytes.
+    :return: The encoded frame as bytes, CRC included.
+    """
+    frame = bytes((slave, function)) + payload
+    return frame + struct.pack("<H", crc16(frame))
+
+
+@functools.lru_cache(maxsize=512)
+def read_coils_frame(slave, address, count):
+    return build_frame(slave, READ_COILS, struct.pack(">HH", address, count))
+
+
+@functools.lru_cache(maxsize=512)
+def read_registers_frame(slave, address, count):
+    return build_frame(
+        slave, READ_HOLDING_REGISTERS, struct.pack(">HH", address, count)
+    )
+
+
+@functools.lru_cache(maxsize=512)
+def write_register_frame(slave, address, value):
+    return build_frame(
+        slave, WRITE_SINGLE_REGISTER, struct.pack(">HH", address, value)
+    )
+
+
+@functools.lru_cache(maxsize=512)
+def write_coil_frame(slave, address, state):
+    return build_frame(
+        slave,
+        WRITE_SINGLE_COIL,
+        struct.pack(">HH", address, COIL_ON if state else COIL_OFF),
+    )
+
+
+@functools.lru_cache(maxsize=512)
+def write_coils_frame(slave, address, states):
+    """
+    Encode a Write Multiple Coils request.
+    :param states: Tuple of booleans, one per coil starting at address.
+    """
+    packed = bytearray((len(states) + 7) // 8)
+    for i, state in enumerate(states):
+        if state:
+            packed[i // 8] |= 1 << (i % 8)
+    payload = struct.pack(">HHB", address, len(states), len(packed)) + packed
+    return build_frame(slave, WRITE_MULTIPLE_COILS, payload)
+
+
+@functools.lru_cache(maxsize=512)
+def write_registers_frame(slave, address, values):
+    """
+    Encode a Write Multiple Registers request.
+    :param values: Tuple of 16-bit values, one per register starting at address.
+    """
+    payload = struct.pack(
+        ">HHB%dH" % len(values), address, len(values), 2 * len(values), *values
+    )
+    return build_frame(slave, WRITE_MULTIPLE_REGISTERS, payload)
+
+
+def expected_length(frame):
+    """
+    Expected length of the normal reply to a request frame.
+    """
+    if frame[1] in (0x01, 0x02):
+        count = frame[4] << 8 | frame[5]
+        return 5 + (count + 7) // 8
+    if frame[1] in (0x03, 0x04):
+        count = frame[4] << 8 | frame[5]
+        return 5 + 2 * count
+    return 8
+
+
+def check_crc(frame):
+    return len(frame) >= 4 and crc16(frame[:-2]) == (frame[-2] | frame[-1] << 8)
+
+
+def decode_frame(frame, slave=None):
+    """
+    Validate a reply frame and split it into its fields.
+    :param frame: The received frame, CRC included.
+    :param slave: Expected slave address, not checked if None.
+    :return: A tuple (slave, function, payload).
+    """
+    if not check_crc(frame):
+        raise ModbusCRCError(f"CRC mismatch in frame {list(frame)}")
+    if slave is not None and frame[0] != slave:
+        raise ModbusError(f"Reply from slave {frame[0]}, expected {slave}")
+    if frame[1] & 0x80:
+        raise ModbusExceptionResponse(frame[0], frame[1] & 0x7F, frame[2])
+    return frame[0], frame[1], frame[2:-2]
+
+
+class ModbusMetrics:
+    """
+    Per slave and function code counters for one bus. Safe to read from any
+    thread while the bus thread records into it.
+    """
+
+    # Upper bounds of the latency histogram buckets in milliseconds, the last
+    # bucket counts everything slower
+    latency_buckets = (5, 10, 20, 50, 100, 200, 500, 1000)
+
+    errors = (
+        (ModbusTimeout, "timeouts"),
+        (ModbusCRCError, "crc_errors"),
+        (ModbusExceptionResponse, "exceptions"),
+        (ModbusDeadlineExceeded, "stale"),
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.reporter = None
+
+    def _entry(self, slave, function):
+        entry = self.entries.get((slave, function))
+        if entry is None:
+            entry = self.entries[(slave, function)] = {
+                "requests": 0,
+                "ok": 0,
+                "timeouts": 0,
+                "crc_errors": 0,
+                "exceptions": 0,
+                "stale": 0,
+                "errors": 0,
+                "retries": 0,
+                "bytes_tx": 0,
+                "bytes_rx": 0,
+                "latency_total": 0.0,
+                "latency_max": 0.0,
+                "latency_histogram": [0] * (len(self.latency_buckets) + 1),
+            }
+        return entry
+
+    def record(self, slave, function, latency, error=None, bytes_tx=0, bytes_rx=0):
+        """
+        Record one attempt of a transaction.
+        :param latency: Seconds from sending the request to the outcome.
+        :param error: The ModbusError raised, None on success.
+        """
+        milliseconds = latency * 1000
+        bucket = bisect.bisect_left(self.latency_buckets, milliseconds)
+        with self.lock:
+            entry = self._entry(slave, function)
+            entry["requests"] += 1
+            entry["bytes_tx"] += bytes_tx
+            entry["bytes_rx"] += bytes_rx
+            if error is None:
+                entry["ok"] += 1
+                entry["latency_total"] += milliseconds
+                entry["latency_max"] = max(entry["latency_max"], milliseconds)
+                entry["latency_histogram"][bucket] += 1
+                return
+            for error_type, counter in self.errors:
+                if isinstance(error, error_type):
+                    entry[counter] += 1
+                    break
+            else:
+                entry["errors"] += 1
+
+    def record_retry(self, slave, function):
+        with self.lock:
+            self._entry(slave, function)["retries"] += 1
+
+    def record_stale(self, slave, function):
+        with self.lock:
+            self._entry(slave, function)["stale"] += 1
+
+    def snapshot(self):
+        """
+        :return: A dictionary of slave -> function code -> counters, with
+            "latency_mean" in milliseconds over successful transactions.
+        """
+        with self.lock:
+            snapshot = {}
+            for (slave, function), entry in self.entries.items():
+                entry = dict(entry, latency_histogram=list(entry["latency_histogram"]))
+                entry["latency_mean"] = (
+                    entry["latency_total"] / entry["ok"] if entry["ok"] else 0.0
+                )
+                snapshot.setdefault(slave, {})[function] = entry
+        return snapshot
+
+    def format(self):
+        lines = []
+        for slave, functions in sorted(self.snapshot().items()):
+            for function, entry in sorted(functions.items()):
+                lines.append(
+                    f"slave {slave} fn {function:#04x}: {entry['requests']} req, "
+                    + f"mean {entry['latency_mean']:.1f} ms, "
+                    + f"max {entry['latency_max']:.1f} ms, "
+                    + f"{entry['timeouts']} timeouts, {entry['crc_errors']} crc, "
+                    + f"{entry['exceptions']} exc, {entry['retries']} retries, "
+                    + f"{entry['stale']} stale, "
+                    + f"{entry['bytes_tx']}/{entry['bytes_rx']} bytes tx/rx"
+                )
+        return "\n".join(lines)
+
+    def start_reporting(self, interval, name="rs485"):
+        """
+        Log a summary of the counters every interval seconds.
+        """
+
+        def report():
+            while True:
+                time.sleep(interval)
+                logger.info("Modbus metrics for %s:\n%s", name, self.format())
+
+        self.reporter = threading.Thread(
+            target=report, name=f"{name}-metrics", daemon=True
+        )
+        self.reporter.start()
+
+
 class Modbus485:
-    def __init__(self, _rs485):
+    def __init__(self, _rs485, timeout=0.5, retries=0, metrics=None):
         self.rs485 = _rs485
+        self.timeout = timeout
+        self.retries = retries
+        self.metrics = metrics or ModbusMetrics()
+
+        # RTU timing: one character is 11 bits on the wire, frames are
+        # separated by at least 3.5 characters of silence (fixed 1.75 ms
+        # above 19200 baud)
+        baudrate = getattr(_rs485, "baudrate", 9600) or 9600
+        self.char_time = 11.0 / baudrate
+        self.frame_gap = 3.5 * self.char_time if baudrate <= 19200 else 0.00175
+        self.last_activity = 0.0
+        # When the last request started going out, for the latency metrics
+        self.sent_at = 0.0
+
+        # Every reply is received into the same buffer, an RTU frame is at
+        # most 256 bytes
+        self.rx_buffer = bytearray(256)
+        self.rx_view = memoryview(self.rx_buffer)
+        self.float_buffer = bytearray(4)
+        self.rx_size = 0
 
     def modbus485_send(self, data):
         ser = self.rs485
@@ -15,72 +337,210 @@ class Modbus485:
         try:
             ser.write(serial.to_bytes(data))
         except Exception as e:
-            print("Modbus485: Failed to write data:", e)
+            logger.error("Failed to write data: %s", e)
             return 0
         return
 
-    def modbus485_read(self):
+    def modbus485_transaction(self, data, response_length, timeout=None, decoder=None):
+        """
+        Send a request frame and read exactly one reply frame.
+        :param data: The request frame as bytes, including CRC.
+        :param response_length: Expected length of a normal reply in bytes.
+        :param timeout: Seconds to wait for the reply, defaults to self.timeout.
+        :param decoder: Called with a memoryview of the reply, which is only
+            valid until the next transaction.
+        :return: What decoder returned, or a copy of the reply as bytes. The
+            reply has its CRC and slave address checked either way.
+        """
+        slave, function = data[0], data[1]
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.metrics.record_retry(slave, function)
+            try:
+                frame = self._exchange(data, response_length, timeout)
+            except ModbusError as e:
+                latency = time.monotonic() - self.sent_at
+                self.metrics.record(
+                    slave, function, latency, e, len(data), self.rx_size
+                )
+                # An exception reply is a definite answer, retrying won't help
+                if isinstance(e, ModbusExceptionResponse) or attempt == self.retries:
+                    raise
+                continue
+            self.metrics.record(
+                slave,
+                function,
+                time.monotonic() - self.sent_at,
+                None,
+                len(data),
+                len(frame),
+            )
+            return decoder(frame) if decoder is not None else bytes(frame)
+
+    def _exchange(self, data, response_length, timeout):
         ser = self.rs485
-        bytesToRead = ser.inWaiting()
-        if bytesToRead > 0:
-            out = ser.read(bytesToRead)
-            data_array = [b for b in out]
-            print("Received Data:", data_array)
-            return data_array
-        return []
+        self.rx_size = 0
+        if timeout is None:
+            timeout = self.timeout
 
-    def modbus485_clear_buffer(self):
+        # Keep the bus silent for one inter-frame gap before talking
+        silence = self.last_activity + self.frame_gap - time.monotonic()
+        if silence > 0:
+            time.sleep(silence)
+
+        # Latency is measured from here, the gap above is deliberate idle time
+        self.sent_at = time.monotonic()
+        try:
+            self.modbus485_clear_buffer()
+            ser.write(data)
+            ser.flush()
+        except Exception as e:
+            self.last_activity = time.monotonic()
+            raise ModbusError(f"Failed to write data: {e}")
+
+        # The request is on the wire, the reply can take at most its own
+        # transmission time on top of the slave's response timeout
+        deadline = time.monotonic() + timeout + response_length * self.char_time
+        if ser.timeout != timeout:
+            ser.timeout = timeout
+
+        # Read address and function first, an exception reply is shorter
+        try:
+            size = self._read_into(0, 2, deadline)
+            if size == 2:
+                if self.rx_buffer[1] & 0x80:
+                    response_length = 5
+                size = self._read_into(size, response_length, deadline)
+        except Exception as e:
+            # E.g. the adapter was unplugged, callers only handle ModbusError
+            self.last_activity = time.monotonic()
+            raise ModbusError(f"Failed to read data: {e}")
+        self.last_activity = time.monotonic()
+        self.rx_size = size
+
+        if size < response_length:
+            raise ModbusTimeout(f"Expected {response_length} bytes, received {size}")
+        frame = self.rx_view[:size]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received Data: %s", frame.hex(" "))
+        decode_frame(frame, data[0])
+        return frame
+
+    def _read_into(self, size, end, deadline):
         ser = self.rs485
-        bytesToRead = ser.inWaiting()
-        if bytesToRead > 0:
-            out = ser.read(bytesToRead)
-            print("Buffer:", out)
+        view = self.rx_view
+        while size < end and time.monotonic() < deadline:
+            received = ser.readinto(view[size:end])
+            if not received:
+                break
+            size += received
+        return size
+
+    def _read_waiting(self):
+        ser = self.rs485
+        size = min(ser.inWaiting(), len(self.rx_buffer))
+        if size > 0:
+            size = ser.readinto(self.rx_view[:size])
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received Data: %s", self.rx_view[:size].hex(" "))
+        return size
 
-    def modbus485_read_adc(self):
+    def modbus485_read(self):
+        size = self._read_waiting()
+        return bytes(self.rx_view[:size])
+
+    def modbus485_clear_buffer(self):
         ser = self.rs485
-        bytesToRead = ser.inWaiting()
-        if bytesToRead > 0:
-            out = ser.read(bytesToRead)
-            data_array = [b for b in out]
-            print(data_array)
-            if len(data_array) > 7:
-                array_size = len(data_array)
-                value = data_array[array_size - 4] * 256 + data_array[array_size - 3]
-                return value
+        if logger.isEnabledFor(logging.DEBUG) and ser.inWaiting() > 0:
+            out = ser.read(ser.inWaiting())
+            logger.debug("Buffer: %s", out.hex(" "))
         else:
+            ser.reset_input_buffer()
+
+    def modbus485_read_adc(self):
+        size = self._read_waiting()
+        if size == 0:
             return 400
+        if size > 7 and check_crc(self.rx_view[:size]):
+            [value] = UINT16.unpack_from(self.rx_buffer, size - 4)
+            return value
         return 404
 
     def modbus485_read_big_endian(self):
-        ser = self.rs485
-        bytesToRead = ser.inWaiting()
-        return_array = [0, 0, 0, 0]
-        if bytesToRead > 0:
-            out = ser.read(bytesToRead)
-            data_array = [b for b in out]
-            print(data_array)
-
-            if len(data_array) >= 7:
-                return_array[0] = data_array[5]
-                return_array[1] = data_array[6]
-                return_array[2] = data_array[3]
-                return_array[3] = data_array[4]
-                print("Modbus485: Raw Data:", return_array)
-
-                [value] = struct.unpack(">f", bytearray(return_array))
-                return value
-        else:
+        size = self._read_waiting()
+        if size == 0:
             return 400
+        if size >= 7 and check_crc(self.rx_view[:size]):
+            # Low word first on the wire
+            buffer = self.float_buffer
+            buffer[0:2] = self.rx_view[5:7]
+            buffer[2:4] = self.rx_view[3:5]
+            [value] = FLOAT32.unpack(buffer)
+            return value
         return 404
 
 
 class Modbus485_:
-    def __init__(self, _rs485):
+    # Register address -> (low, high) of the random values a read returns,
+    # anything else reads as 20-80 until written
+    value_ranges = {0: (0, 100), 6: (20, 30)}
+
+    def __init__(self, _rs485, metrics=None):
         self.rs485 = _rs485
+        self.registers = {}
+        self.metrics = metrics or ModbusMetrics()
 
     def modbus485_send(self, data):
         return
 
+    def modbus485_transaction(self, data, response_length, timeout=None, decoder=None):
+        reply = self.reply(bytes(data))
+        try:
+            decode_frame(reply, data[0])
+        except ModbusError as e:
+            self.metrics.record(data[0], data[1], 0.0, e, len(data), len(reply))
+            raise
+        self.metrics.record(data[0], data[1], 0.0, None, len(data), len(reply))
+        return decoder(memoryview(reply)) if decoder is not None else reply
+
+    def reply(self, data):
+        slave, function = data[0], data[1]
+        address, count = struct.unpack(">HH", data[2:6])
+
+        if function in (READ_COILS, READ_HOLDING_REGISTERS):
+            values = [
+                self.registers.get(
+                    (slave, address + i),
+                    random.randint(*self.value_ranges.get(address + i, (20, 80))),
+                )
+                for i in range(count)
+            ]
+            if function == READ_COILS:
+                packed = bytearray((count + 7) // 8)
+                for i, value in enumerate(values):
+                    if value:
+                        packed[i // 8] |= 1 << (i % 8)
+                return build_frame(slave, function, bytes([len(packed)]) + packed)
+            payload = struct.pack(">B%dH" % count, 2 * count, *values)
+            return build_frame(slave, function, payload)
+
+        if function in (WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER):
+            self.registers[(slave, address)] = count
+        elif function == WRITE_MULTIPLE_REGISTERS:
+            values = struct.unpack(">%dH" % count, data[7 : 7 + 2 * count])
+            for i, value in enumerate(values):
+                self.registers[(slave, address + i)] = value
+        elif function == WRITE_MULTIPLE_COILS:
+            for i in range(count):
+                state = data[7 + i // 8] & (1 << (i % 8))
+                self.registers[(slave, address + i)] = COIL_ON if state else COIL_OFF
+        else:
+            # Illegal function
+            return build_frame(slave, function | 0x80, b"\x01")
+        if function in (WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS):
+            return build_frame(slave, function, data[2:6])
+        return data
+
     def modbus485_read(self):
         return []
 
@@ -94,85 +554,393 @@ class Modbus485_:
         return 0
 
 
-class SensorRelayController:
-    relay_commands = {
-        1: ([1, 6, 0, 0, 255, 201, 138], [1, 6, 0, 0, 0, 137, 202]),
-        2: ([2, 6, 0, 0, 255, 201, 185], [2, 6, 0, 0, 0, 137, 249]),
-        3: ([3, 6, 0, 0, 255, 200, 104], [3, 6, 0, 0, 0, 136, 40]),
-        4: ([4, 6, 0, 0, 255, 201, 223], [4, 6, 0, 0, 0, 137, 159]),
-        5: ([5, 6, 0, 0, 255, 200, 144], [5, 6, 0, 0, 0, 136, 78]),
-        6: ([6, 6, 0, 0, 255, 200, 61], [6, 6, 0, 0, 0, 136, 127]),
-        7: ([7, 6, 0, 0, 255, 201, 236], [7, 6, 0, 0, 0, 137, 172]),
-        8: ([8, 6, 0, 0, 255, 201, 19], [8, 6, 0, 0, 0, 137, 83]),
-    }
+class ModbusBus:
+    """
+    Owner of one RS485 bus. A single worker thread runs every transaction,
+    highest priority first, so relay commands overtake queued sensor polls.
+    """
 
-    soil_temperature_command = [10, 3, 0, 6, 0, 1, 101, 112]
-    soil_moisture_command = [10, 3, 0, 7, 0, 1, 52, 176]
-
-    def __init__(self, modbus):
+    def __init__(self, modbus, name="rs485"):
         self.modbus = modbus
+        self.name = name
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(
+        self,
+        data,
+        response_length=None,
+        priority=PRIORITY_POLL,
+        deadline=None,
+        timeout=None,
+        decoder=None,
+    ):
+        """
+        Queue a transaction on the bus.
+        :param data: The request frame, including CRC.
+        :param response_length: Expected reply length, derived from the
+            request if None.
+        :param priority: One of the PRIORITY_* constants, lower runs first.
+        :param deadline: time.monotonic() value after which the request is
+            stale and dropped without touching the bus.
+        :param timeout: Reply timeout passed to the transaction.
+        :param decoder: Runs on the bus thread with a memoryview of the
+            reply, see Modbus485.modbus485_transaction.
+        :return: A Future resolving to the decoded reply, or its bytes.
+        """
+        if response_length is None:
+            response_length = expected_length(data)
+        future = Future()
+        self.queue.put(
+            (
+                priority,
+                next(self.counter),
+                (future, data, response_length, deadline, timeout, decoder),
+            )
+        )
+        return future
+
+    def modbus485_transaction(
+        self, data, response_length, timeout=None, decoder=None, priority=PRIORITY_POLL
+    ):
+        future = self.submit(data, response_length, priority, None, timeout, decoder)
+        return future.result()
+
+    @property
+    def metrics(self):
+        return self.modbus.metrics
+
+    def close(self):
+        self.queue.put((float("inf"), next(self.counter), None))
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            _, _, item = self.queue.get()
+            if item is None:
+                break
+            future, data, response_length, deadline, timeout, decoder = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            if deadline is not None and time.monotonic() > deadline:
+                self.metrics.record_stale(data[0], data[1])
+                future.set_exception(
+                    ModbusDeadlineExceeded(f"Request {list(data)} went stale")
+                )
+                continue
+            try:
+                reply = self.modbus.modbus485_transaction(
+                    data, response_length, timeout, decoder
+                )
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(reply)
+
+
+def _acknowledge(frame):
+    return True
+
+
+def bus_configs(config):
+    """
+    Settings of every RS485 bus in the "modbus" config section.
+    :return: A dictionary of bus name -> settings. A config without "buses"
+        describes one bus named "default" with its settings at the top level.
+    """
+    config = config or {}
+    if "buses" in config:
+        return config["buses"]
+    keys = ("port", "baudrate", "timeout", "retries", "boards")
+    return {"default": {key: config[key] for key in keys if key in config}}
+
+
+def open_buses(config):
+    """
+    Open every configured serial port and start a bus owner for each, using
+    the in-process stub for ports that cannot be opened.
+    :return: A dictionary of bus name -> ModbusBus.
+    """
+    config = config or {}
+    buses = {}
+    for name, settings in bus_configs(config).items():
+        try:
+            ser = serial.Serial(
+                port=settings.get("port", "/dev/ttyUSB0"),
+                baudrate=settings.get("baudrate", 9600),
+            )
+        except Exception as e:
+            ser = None
+            logger.error("Failed to open port: %s", e)
+
+        if ser is not None:
+            m485 = Modbus485(
+                ser,
+                timeout=settings.get("timeout", 0.5),
+                retries=settings.get("retries", 1),
+            )
+        else:
+            m485 = Modbus485_(ser)
+        m485.metrics.start_reporting(config.get("metrics_interval", 300), name)
+        buses[name] = ModbusBus(m485, name)
+    return buses
 
-    # def get_sensor_data(self):
-    #     # Get soil temperature
-    #     self.modbus.modbus485_send(self.soil_temperature_command)
-    #     time.sleep(1)
-    #     soil_temp = self.modbus.modbus485_read_adc()
-
-    #     # Get soil moisture
-    #     self.modbus.modbus485_send(self.soil_moisture_command)
-    #     time.sleep(1)
-    #     soil_moist = self.modbus.modbus485_read_adc()
 
-    #     return soil_temp, soil_moist
+class SensorRelayController:
+    default_sensors = {
+        "area1": {"slave": 10},
+        "area2": {"slave": 11},
+        "area3": {"slave": 12},
+    }
+    default_sensor_registers = {"temperature": 6, "moisture": 7, "humidity": 8}
+    default_levels = {
+        "slave": 20,
+        "registers": {"water": 0, "mixer1": 1, "mixer2": 2, "mixer3": 3},
+    }
 
-    def get_soil_data(self):
-        # Get soil temperature
-        soil_temp = random.randint(20, 30)
+    def __init__(self, buses, config=None):
+        """
+        :param buses: A dictionary of bus name -> ModbusBus, or a single
+            ModbusBus for a one-bus setup.
+        :param config: The "modbus" config section. Relays, sensors and
+            levels name their bus with "bus", the first bus by default.
+        """
+        config = config or {}
+        settings = bus_configs(config)
+        if not isinstance(buses, dict):
+            buses = {next(iter(settings)): buses}
+        self.buses = buses
+        default_bus = next(iter(settings))
+
+        # Relay number -> (bus, slave address, address on the board), one
+        # single-channel board per relay unless configured otherwise
+        relays = config.get(
+            "relays", {i: {"slave": i, "address": 0} for i in range(1, 9)}
+        )
+        self.relays = {
+            int(num): (
+                relay.get("bus", default_bus),
+                relay["slave"],
+                relay.get("address", 0),
+            )
+            for num, relay in relays.items()
+        }
+
+        # (bus, slave address) -> board capabilities. "mode" selects coils or
+        # holding registers, "bulk" whether the board accepts function
+        # 0x0F/0x10 for several channels in one request
+        self.boards = {
+            (name, int(slave)): board
+            for name, bus_settings in settings.items()
+            for slave, board in bus_settings.get("boards", {}).items()
+        }
+
+        # Area -> soil sensor, every value of a sensor comes from one read
+        # spanning its lowest to highest register
+        self.sensors = {
+            area: self._sensor_read(
+                sensor.get("bus", default_bus),
+                sensor["slave"],
+                sensor.get("registers", self.default_sensor_registers),
+                sensor.get("scale", 1),
+            )
+            for area, sensor in config.get("sensors", self.default_sensors).items()
+        }
+        levels = config.get("levels", self.default_levels)
+        self.levels = self._sensor_read(
+            levels.get("bus", default_bus),
+            levels["slave"],
+            levels["registers"],
+            levels.get("scale", 1),
+        )
+        self.sweep_timeout = config.get("sweep_timeout", 1.0)
+
+    @staticmethod
+    def _sensor_read(bus, slave, registers, scale):
+        first = min(registers.values())
+        count = max(registers.values()) - first + 1
+        return {
+            "bus": bus,
+            "slave": slave,
+            "command": read_registers_frame(slave, first, count),
+            "decoder": functools.partial(
+                SensorRelayController._decode_sensor,
+                struct.Struct(">%dh" % count).unpack_from,
+                {name: address - first for name, address in registers.items()},
+                scale,
+            ),
+        }
+
+    @staticmethod
+    def _decode_sensor(unpack_from, offsets, scale, frame):
+        # Register values start after address, function and byte count
+        values = unpack_from(frame, 3)
+        return {
+            name: values[offset] * scale if scale != 1 else values[offset]
+            for name, offset in offsets.items()
+        }
+
+    def sweep_soil_data(self):
+        """
+        Read every soil sensor. All requests are queued at once, so each bus
+        works through its own sensors in parallel with the others.
+        :return: A dictionary of area -> {"temperature", "humidity",
+            "moisture"}, areas whose sensor did not answer are left out.
+        """
+        deadline = time.monotonic() + self.sweep_timeout
+        pending = {
+            area: self.buses[sensor["bus"]].submit(
+                sensor["command"], deadline=deadline, decoder=sensor["decoder"]
+            )
+            for area, sensor in self.sensors.items()
+        }
 
-        # Get soil humidity
-        soil_humid = random.randint(20, 80)
+        results = {}
+        for area, future in pending.items():
+            try:
+                results[area] = future.result()
+            except ModbusError as e:
+                logger.warning("Soil sensor %s: %s", area, e)
+        return results
 
-        # Get soil moisture
-        soil_moist = random.randint(20, 80)
+    def read_sensor(self, sensor):
+        bus = self.buses[sensor["bus"]]
+        return bus.submit(sensor["command"], decoder=sensor["decoder"]).result()
 
-        return soil_temp, soil_humid, soil_moist
+    def get_soil_data(self, area="area1"):
+        data = self.read_sensor(self.sensors[area])
+        return data["temperature"], data["humidity"], data["moisture"]
 
     def get_level_data(self):
-        # Get water level
-        water_level = random.randint(0, 100)
-
-        # Get mixer1 level
-        mixer1_level = random.randint(0, 100)
-
-        # Get mixer2 level
-        mixer2_level = random.randint(0, 100)
-
-        # Get mixer3 level
-        mixer3_level = random.randint(0, 100)
-
-        return water_level, mixer1_level, mixer2_level, mixer3_level
+        data = self.read_sensor(self.levels)
+        return data["water"], data["mixer1"], data["mixer2"], data["mixer3"]
 
     def control_relay(self, relay_num, state):
-        if relay_num in self.relay_commands:
-            command = (
-                self.relay_commands[relay_num][0]
-                if state
-                else self.relay_commands[relay_num][1]
-            )
-            self.modbus.modbus485_send(command)
-            time.sleep(1)
-        else:
-            print(f"Invalid relay number: {relay_num}")
+        if relay_num in self.relays:
+            return self.set_relays({relay_num: state})[relay_num]
+        logger.error("Invalid relay number: %s", relay_num)
+        return False
+
+    def set_relays(self, states, priority=PRIORITY_RELAY):
+        """
+        Switch several relays, using one transaction per board and run of
+        adjacent channels where the board supports it.
+        :param states: A dictionary of relay number -> bool.
+        :param priority: Bus priority, PRIORITY_SAFETY for emergency stops.
+        :return: A dictionary of relay number -> True if the board acknowledged.
+        """
+        groups = {}
+        for relay_num, state in states.items():
+            if relay_num not in self.relays:
+                logger.error("Invalid relay number: %s", relay_num)
+                continue
+            bus, slave, address = self.relays[relay_num]
+            groups.setdefault((bus, slave), {})[address] = (relay_num, bool(state))
+
+        pending = []
+        for (bus, slave), channels in groups.items():
+            board = self.boards.get((bus, slave), {})
+            coils = board.get("mode", "register") == "coil"
+            if board.get("bulk", False):
+                runs = self._runs(sorted(channels))
+            else:
+                runs = [[address] for address in channels]
+
+            for run in runs:
+                relay_nums = [channels[address][0] for address in run]
+                values = tuple(channels[address][1] for address in run)
+                command = self._relay_frame(slave, run[0], values, coils)
+                future = self.buses[bus].submit(
+                    command, priority=priority, decoder=_acknowledge
+                )
+                pending.append((relay_nums, future))
+
+        # All frames are queued back-to-back before waiting on any reply
+        results = {}
+        for relay_nums, future in pending:
+            try:
+                future.result()
+                ok = True
+            except ModbusError as e:
+                logger.warning("Relay %s: %s", ", ".join(map(str, relay_nums)), e)
+                ok = False
+            for relay_num in relay_nums:
+                results[relay_num] = ok
+        return results
+
+    def read_relays(self, relay_nums):
+        """
+        Read back the state of several relays from their boards.
+        :param relay_nums: An iterable of relay numbers.
+        :return: A dictionary of relay number -> bool, or None if unreadable.
+        """
+        groups = {}
+        for relay_num in relay_nums:
+            if relay_num in self.relays:
+                bus, slave, address = self.relays[relay_num]
+                groups.setdefault((bus, slave), {})[address] = relay_num
+
+        pending = []
+        for (bus, slave), channels in groups.items():
+            board = self.boards.get((bus, slave), {})
+            coils = board.get("mode", "register") == "coil"
+            for run in self._runs(sorted(channels)):
+                if coils:
+                    command = read_coils_frame(slave, run[0], len(run))
+                else:
+                    command = read_registers_frame(slave, run[0], len(run))
+                decoder = functools.partial(self._decode_relays, len(run), coils)
+                future = self.buses[bus].submit(command, decoder=decoder)
+                pending.append((slave, channels, run, future))
+
+        results = {}
+        for slave, channels, run, future in pending:
+            try:
+                states = future.result()
+            except ModbusError as e:
+                logger.warning("Relay readback from slave %s: %s", slave, e)
+                states = [None] * len(run)
+            for address, state in zip(run, states):
+                results[channels[address]] = state
+        return results
+
+    @staticmethod
+    def _decode_relays(count, coils, frame):
+        if coils:
+            return [bool(frame[3 + i // 8] & (1 << (i % 8))) for i in range(count)]
+        return [value != 0 for value in UINT16S[count].unpack_from(frame, 3)]
+
+    @staticmethod
+    def _runs(addresses):
+        runs = []
+        for address in addresses:
+            if runs and address == runs[-1][-1] + 1:
+                runs[-1].append(address)
+            else:
+                runs.append([address])
+        return runs
+
+    @staticmethod
+    def _relay_frame(slave, address, states, coils):
+        if coils:
+            if len(states) == 1:
+                return write_coil_frame(slave, address, states[0])
+            return write_coils_frame(slave, address, states)
+        values = tuple(RELAY_ON if state else RELAY_OFF for state in states)
+        if len(values) == 1:
+            return write_register_frame(slave, address, values[0])
+        return write_registers_frame(slave, address, values)
 
 
 if __name__ == "__main__":
-    try:
-        ser = serial.Serial(port="/dev/ttyUSB0", baudrate=9600)
-    except Exception as e:
-        print("Modbus485: Failed to open port:", e)
+    import json
+
+    with open("config.json", "r") as f:
+        modbus_config = json.load(f).get("modbus", {})
 
-    m485 = Modbus485(ser)
-    controller = SensorRelayController(m485)
+    controller = SensorRelayController(open_buses(modbus_config), modbus_config)
 
     # # Test relay ON/OFF
     # for i in range(1, 9):
@@ -182,6 +950,5 @@ if __name__ == "__main__":
     #     controller.control_relay(i, False)
 
     # Test sensor data retrieval
-    soil_temp, soil_moist = controller.get_sensor_data()
-    print(f"Soil Temperature: {soil_temp}")
-    print(f"Soil Moisture: {soil_moist}")
+    for area, data in controller.sweep_soil_data().items():
+        print(f"{area}: {data}")
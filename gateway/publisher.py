@@ -0,0 +1,536 @@
+import collections
+import copy
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FeedPublisher:
+    """
+    Publishes a feed only when its value really changed since the last
+    publish, or when the heartbeat interval ran out.
+    """
+
+    def __init__(
+        self, client, deadbands=None, heartbeat=300, clock=None, echo_feeds=()
+    ):
+        """
+        :param client: Anything with publish(feed, payload), e.g. MQTTClient.
+        :param deadbands: A dictionary of feed -> how far a number has to move
+            from its last published value to count as a change.
+        :param heartbeat: Seconds after which a feed is republished even if
+            nothing changed, so subscribers can tell the gateway is alive.
+        :param clock: Returns seconds for the heartbeat, time.monotonic if
+            None.
+        :param echo_feeds: Feeds the gateway also subscribes to, their
+            payloads are remembered so is_echo() can tell the broker's echo
+            from a command.
+        """
+        self.client = client
+        self.clock = clock or time.monotonic
+        self.deadbands = deadbands or {}
+        self.heartbeat = heartbeat
+
+        self.last_values = {}
+        self.last_times = {}
+        self.stats = {"published": 0, "suppressed": 0}
+        self.echo_feeds = set(echo_feeds)
+        # Feed -> payloads sent and not echoed back yet, is_echo() runs on
+        # the MQTT thread
+        self.echoes = {feed: collections.deque(maxlen=16) for feed in echo_feeds}
+        self.echo_lock = threading.Lock()
+
+    def publish(self, feed, value, force=False):
+        """
+        :param value: A JSON serializable value.
+        :param force: Publish even if unchanged, for one-off events.
+        :return: True if the value was published.
+        """
+        now = self.clock()
+        if (
+            not force
+            and feed in self.last_values
+            and now - self.last_times[feed] < self.heartbeat
+            and not self.changed(
+                self.last_values[feed], value, self.deadbands.get(feed, 0)
+            )
+        ):
+            self.stats["suppressed"] += 1
+            return False
+
+        payload = json.dumps(value, ensure_ascii=False)
+        if feed in self.echo_feeds:
+            # Before publishing, a client may echo right away
+            with self.echo_lock:
+                self.echoes[feed].append(payload)
+        self.client.publish(feed, payload)
+        # Keep a private copy, callers pass in live state
+        self.last_values[feed] = copy.deepcopy(value)
+        self.last_times[feed] = now
+        self.stats["published"] += 1
+        return True
+
+    def is_echo(self, feed, payload):
+        """
+        :return: True if the payload is one this publisher sent on the feed,
+            each sent payload is only matched once.
+        """
+        with self.echo_lock:
+            echoes = self.echoes.get(feed)
+            if echoes and payload in echoes:
+                echoes.remove(payload)
+                return True
+        return False
+
+    def changed(self, old, new, deadband):
+        if isinstance(old, dict) and isinstance(new, dict):
+            return old.keys() != new.keys() or any(
+                self.changed(old[key], new[key], deadband) for key in old
+            )
+        if isinstance(old, list) and isinstance(new, list):
+            return len(old) != len(new) or any(
+                self.changed(a, b, deadband) for a, b in zip(old, new)
+            )
+        if is_number(old) and is_number(new):
+            return abs(new - old) > deadband
+        return old != new
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        """
+        :param rate: Tokens added per second.
+        :param burst: Most tokens that can be saved up.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self, now):
+        """
+        :return: Seconds until a token is available, 0 if one is now.
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OfflineStore:
+    """
+    Bounded on-disk queue of messages that could not be sent. Once full, the
+    oldest messages are overwritten like in a ring buffer.
+    """
+
+    def __init__(self, path="outbox.db", maxrows=10000):
+        """
+        :param path: SQLite database file, kept across restarts.
+        :param maxrows: Most messages kept.
+        """
+        self.maxrows = maxrows
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Appends do not block readers and survive a crash of the process
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            + "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            + "time REAL, feed TEXT, payload TEXT)"
+        )
+        self.db.commit()
+        self.count = self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def extend(self, messages, latest_only=()):
+        """
+        :param messages: (feed, payload, time queued) tuples, oldest first.
+        :param latest_only: Feeds whose stored messages are replaced by the
+            new one instead of kept.
+        :return: The number of old messages overwritten.
+        """
+        replaced = {feed for feed, _, _ in messages if feed in latest_only}
+        with self.db:
+            for feed in replaced:
+                self.count -= self.db.execute(
+                    "DELETE FROM outbox WHERE feed = ?", (feed,)
+                ).rowcount
+            self.db.executemany(
+                "INSERT INTO outbox (time, feed, payload) VALUES (?, ?, ?)",
+                [(created, feed, payload) for feed, payload, created in messages],
+            )
+            self.count += len(messages)
+            overflow = max(0, self.count - self.maxrows)
+            if overflow:
+                self.db.execute(
+                    "DELETE FROM outbox WHERE id IN "
+                    + "(SELECT id FROM outbox ORDER BY id LIMIT ?)",
+                    (overflow,),
+                )
+                self.count -= overflow
+        return overflow
+
+    def peek(self, n):
+        """
+        :return: Up to n of the oldest (id, feed, time, payload) rows.
+        """
+        return self.db.execute(
+            "SELECT id, feed, time, payload FROM outbox ORDER BY id LIMIT ?", (n,)
+        ).fetchall()
+
+    def discard(self, feed):
+        """
+        Delete every message of a feed.
+        """
+        with self.db:
+            deleted = self.db.execute(
+                "DELETE FROM outbox WHERE feed = ?", (feed,)
+            ).rowcount
+        self.count -= deleted
+
+    def remove(self, last_id):
+        """
+        Delete every message up to and including last_id.
+        """
+        with self.db:
+            deleted = self.db.execute(
+                "DELETE FROM outbox WHERE id <= ?", (last_id,)
+            ).rowcount
+        self.count -= deleted
+
+    def close(self):
+        self.db.close()
+
+
+class PublishQueue:
+    """
+    Sends messages from a background thread so the control loop never waits
+    on the broker. A message that is still waiting is replaced by a newer
+    one for the same feed, and sending is paced by a global and a per-feed
+    token bucket to stay under the broker's rate limits.
+
+    While the broker is unreachable, messages are spooled to the offline
+    store. Once it is back they are replayed oldest first with the tokens
+    live messages leave, so the dashboard's latest values stay current
+    while the outage is backfilled.
+    """
+
+    def __init__(
+        self,
+        client,
+        maxsize=100,
+        rate=0.5,
+        burst=10,
+        feed_rate=1.0,
+        feed_burst=2,
+        no_coalesce=("taskHistory", "taskSync"),
+        store=None,
+        replay_batch=50,
+        latest_only=("monitor",),
+        send_batch=None,
+    ):
+        """
+        :param client: Anything with publish(feed, payload), e.g. MQTTClient.
+        :param maxsize: Most messages waiting, the oldest one is dropped
+            when a new message does not fit.
+        :param rate: Messages per second across all feeds. Adafruit IO free
+            accounts allow 30 per minute.
+        :param burst: Messages that can be sent back-to-back.
+        :param feed_rate: Messages per second for a single feed.
+        :param feed_burst: Messages that can be sent back-to-back on a feed.
+        :param no_coalesce: Feeds whose every message has to be sent.
+        :param store: OfflineStore for messages that could not be sent,
+            without one they are dropped.
+        :param replay_batch: Messages read from the store at a time, they
+            are deleted once the whole batch was sent.
+        :param latest_only: Feeds of which only the newest stored message
+            is replayed. The gateway subscribes to its own monitor feed, an
+            old state replayed there would come back as a command.
+        :param send_batch: Called with a feed and a list of (time queued,
+            payload) to send replayed messages with the time they were
+            queued, e.g. through the REST batch endpoint. Without it they
+            are published again and stamped with the time of the replay.
+        """
+        self.client = client
+        self.maxsize = maxsize
+        self.bucket = TokenBucket(rate, burst)
+        self.feed_rate = feed_rate
+        self.feed_burst = feed_burst
+        self.feed_buckets = {}
+        self.no_coalesce = set(no_coalesce)
+        self.store = store
+        self.replay_batch = replay_batch
+        self.latest_only = set(latest_only)
+        self.send_batch = send_batch
+
+        # Key -> (feed, payload, time queued) in sending order, the key is
+        # the feed for coalescing feeds and (feed, sequence number) for the
+        # others
+        self.pending = collections.OrderedDict()
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.online = False
+        self.running = False
+        self.thread = None
+        self.metrics = {
+            "queued": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "sent": 0,
+            "failed": 0,
+            "max_depth": 0,
+            "spooled": 0,
+            "replayed": 0,
+        }
+
+    @classmethod
+    def from_config(cls, client, config, send_batch=None):
+        """
+        :param config: The "publish" section of config.json.
+        """
+        keys = (
+            "maxsize",
+            "rate",
+            "burst",
+            "feed_rate",
+            "feed_burst",
+            "no_coalesce",
+            "replay_batch",
+            "latest_only",
+        )
+        kwargs = {key: config[key] for key in keys if key in config}
+        if config.get("store"):
+            kwargs["store"] = OfflineStore(
+                config["store"], config.get("store_rows", 10000)
+            )
+        return cls(client, send_batch=send_batch, **kwargs)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="publisher", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        """
+        Stop the thread, messages still waiting are spooled to the store and
+        sent after the next start.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        if self.store is not None:
+            self.store.close()
+
+    def set_online(self, online):
+        """
+        Called from the MQTT connect and disconnect callbacks.
+        """
+        with self.condition:
+            self.online = online
+            self.condition.notify()
+
+    def publish(self, feed, payload):
+        with self.condition:
+            if feed in self.no_coalesce:
+                key = (feed, self.sequence)
+                self.sequence += 1
+            else:
+                key = feed
+            if key in self.pending:
+                # Keeps its place in line, only the value is replaced
+                self.metrics["coalesced"] += 1
+            elif len(self.pending) >= self.maxsize:
+                self.pending.popitem(last=False)
+                self.metrics["dropped"] += 1
+            self.pending[key] = (feed, payload, time.time())
+            self.metrics["queued"] += 1
+            depth = len(self.pending)
+            self.metrics["max_depth"] = max(self.metrics["max_depth"], depth)
+            self.condition.notify()
+
+    def depth(self):
+        with self.condition:
+            return len(self.pending)
+
+    def backlog(self):
+        return self.store.count if self.store is not None else 0
+
+    def stats(self):
+        with self.condition:
+            return dict(self.metrics, depth=len(self.pending), backlog=self.backlog())
+
+    def feed_bucket(self, feed):
+        bucket = self.feed_buckets.get(feed)
+        if bucket is None:
+            bucket = TokenBucket(self.feed_rate, self.feed_burst)
+            self.feed_buckets[feed] = bucket
+        return bucket
+
+    def _next(self):
+        # Called with the condition held, returns the first message whose
+        # feed may send now, or how long to wait for one
+        now = time.monotonic()
+        wait = self.bucket.delay(now)
+        if wait > 0:
+            return None, wait
+        for key, message in self.pending.items():
+            feed = message[0]
+            feed_wait = self.feed_bucket(feed).delay(now)
+            if feed_wait == 0:
+                del self.pending[key]
+                self.bucket.take()
+                self.feed_bucket(feed).take()
+                return message, 0.0
+            wait = feed_wait if wait == 0 else min(wait, feed_wait)
+        return None, wait
+
+    def _run(self):
+        # Rows read from the store and not yet sent, only this thread
+        # touches the store
+        replay = collections.deque()
+        while True:
+            with self.condition:
+                while (
+                    self.running
+                    and not self.pending
+                    and not (self.online and (replay or self.backlog()))
+                ):
+                    self.condition.wait()
+                running = self.running
+                online = self.online
+                spool = []
+                message = None
+                wait = 0.0
+                if not running or not online:
+                    spool = list(self.pending.values())
+                    self.pending.clear()
+                elif self.pending:
+                    # Live messages go first, the backlog gets the tokens
+                    # they leave
+                    message, wait = self._next()
+
+            if spool:
+                self._spool(spool)
+                self._skip(replay, {feed for feed, _, _ in spool})
+            if not running:
+                return
+            if not online:
+                replay.clear()
+                continue
+
+            if message is not None:
+                feed, payload, _ = message
+                self._send(feed, payload)
+                if feed in self.latest_only and (replay or self.backlog()):
+                    # Stored states of the feed are older than this one
+                    self._discard(feed, replay)
+                continue
+
+            if replay or self.backlog():
+                replay_wait = self._replay(replay)
+                if replay_wait == 0:
+                    continue
+                wait = replay_wait if wait == 0 else min(wait, replay_wait)
+            with self.condition:
+                self.condition.wait(wait)
+
+    def _replay(self, replay):
+        # Sends the next stored rows, returns how long to wait if the rate
+        # limit does not allow it yet
+        if not replay:
+            replay.extend(self.store.peek(self.replay_batch))
+        row_id, feed, _, _ = replay[0]
+        if feed is None:
+            replay.popleft()
+            if not replay:
+                self.store.remove(row_id)
+            return 0.0
+        now = time.monotonic()
+        feed_bucket = self.feed_bucket(feed)
+        wait = max(self.bucket.delay(now), feed_bucket.delay(now))
+        if wait > 0:
+            return wait
+
+        # As many rows of the feed as there are tokens for go together
+        count = min(self.bucket.tokens, feed_bucket.tokens)
+        rows = []
+        while replay and replay[0][1] == feed and len(rows) < count:
+            rows.append(replay.popleft())
+            self.bucket.take()
+            feed_bucket.take()
+        self.metrics["replayed"] += self._send_rows(feed, rows)
+        if not replay:
+            self.store.remove(rows[-1][0])
+        return 0.0
+
+    def _send_rows(self, feed, rows):
+        if self.send_batch is None:
+            return sum(self._send(feed, payload) for _, _, _, payload in rows)
+        try:
+            self.send_batch(
+                feed, [(created, payload) for _, _, created, payload in rows]
+            )
+        except Exception as e:
+            self.metrics["failed"] += len(rows)
+            logger.error("Replaying %d %s messages failed: %r", len(rows), feed, e)
+            return 0
+        self.metrics["sent"] += len(rows)
+        return len(rows)
+
+    def _skip(self, replay, feeds):
+        # Rows of the batch being replayed that the store no longer has are
+        # skipped. They stay in line so the batch is still removed up to its
+        # last id
+        stale = feeds & self.latest_only
+        for i, row in enumerate(replay):
+            if row[1] in stale:
+                replay[i] = (row[0], None, None, None)
+
+    def _discard(self, feed, replay):
+        try:
+            self.store.discard(feed)
+        except sqlite3.Error as e:
+            logger.error("Discarding stored %s messages failed: %r", feed, e)
+        self._skip(replay, {feed})
+
+    def _send(self, feed, payload):
+        # Losing the connection shows up in the disconnect callback, an
+        # error here means the client rejected the message
+        try:
+            self.client.publish(feed, payload)
+        except Exception as e:
+            self.metrics["failed"] += 1
+            logger.error("Publishing %s failed: %r", feed, e)
+            return False
+        self.metrics["sent"] += 1
+        return True
+
+    def _spool(self, messages):
+        if self.store is None:
+            self.metrics["dropped"] += len(messages)
+            return
+        try:
+            overwritten = self.store.extend(messages, self.latest_only)
+        except sqlite3.Error as e:
+            logger.error("Spooling %d messages failed: %r", len(messages), e)
+            self.metrics["dropped"] += len(messages)
+            return
+        self.metrics["spooled"] += len(messages)
+        self.metrics["dropped"] += overwritten
@@ -0,0 +1,374 @@
+import argparse
+import copy
+import heapq
+import json
+import math
+import random
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from clock import SimulatedClock
+from modbus import (
+    COIL_ON,
+    RELAY_ON,
+    Modbus485_,
+    ModbusBus,
+    SensorRelayController,
+    bus_configs,
+)
+from smart_farm import SmartFarm
+
+DAY = 24 * 3600
+
+
+class InMemoryBroker:
+    """
+    Stands in for the Adafruit IO MQTTClient. Publishes are recorded with
+    the simulated time, and echoed to subscribed feeds like the real broker
+    does.
+    """
+
+    def __init__(self, clock, echo=True):
+        self.clock = clock
+        self.echo = echo
+        self.subscriptions = set()
+        self.published = []
+        self.connected = False
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_subscribe = None
+
+    def connect(self):
+        self.connected = True
+        self.on_connect(self)
+
+    def disconnect(self):
+        self.connected = False
+        self.on_disconnect(self)
+
+    def loop(self, timeout_sec=1.0):
+        # Messages are delivered as they are published, nothing to process
+        time.sleep(timeout_sec)
+
+    def is_connected(self):
+        return self.connected
+
+    def subscribe(self, feed):
+        self.subscriptions.add(feed)
+        self.on_subscribe(self, None, len(self.subscriptions), (0,))
+
+    def publish(self, feed, payload):
+        self.published.append((self.clock.elapsed, feed, payload))
+        if self.echo:
+            self.deliver(feed, payload)
+
+    def deliver(self, feed, payload):
+        """
+        Send a message to the gateway as if it came from the dashboard.
+        """
+        if self.connected and feed in self.subscriptions:
+            self.on_message(self, feed, payload)
+
+    def messages(self, feed):
+        """
+        :return: (seconds since the start, decoded payload) of everything
+            published on a feed.
+        """
+        return [
+            (t, json.loads(payload))
+            for t, published, payload in self.published
+            if published == feed
+        ]
+
+
+class ThresholdModel:
+    """
+    Stands in for the trained watering model, waters below a moisture
+    threshold.
+    """
+
+    def __init__(self, threshold=40):
+        self.threshold = threshold
+
+    def preprocess_and_predict(self, input_data):
+        return 1 if input_data["Soil Moisture"] < self.threshold else 0
+
+    def predict_batch(self, features):
+        return features[:, 0] < self.threshold
+
+
+class SyntheticField:
+    """
+    Soil that dries during the day and gets wetter while its zone is
+    watered, with temperature and air humidity following the sun.
+    """
+
+    def __init__(self, zones, seed=0, dry_rate=2.0, water_rate=30.0):
+        """
+        :param zones: Zone names.
+        :param seed: Seed for the sensor noise.
+        :param dry_rate: Moisture lost per hour at 25 °C.
+        :param water_rate: Moisture gained per hour of watering.
+        """
+        self.zones = list(zones)
+        self.random = np.random.default_rng(seed)
+        self.dry_rate = dry_rate
+        self.water_rate = water_rate
+        self.moisture = self.random.uniform(40, 70, len(self.zones))
+        # Recorded readings replacing the model, zone -> {name: value}
+        self.recorded = {}
+        self.watered = np.zeros(len(self.zones))
+        self.last = 0.0
+
+    def step(self, elapsed, watering):
+        """
+        :param elapsed: Simulated seconds since the start.
+        :param watering: A boolean array, which zones are being watered.
+        :return: A dictionary of zone -> {"temperature", "humidity",
+            "moisture"}.
+        """
+        hours = (elapsed - self.last) / 3600
+        self.last = elapsed
+        hour_of_day = (elapsed % DAY) / 3600
+        temperature = 24 + 6 * math.sin((hour_of_day - 9) / 24 * 2 * math.pi)
+
+        self.moisture -= hours * self.dry_rate * (1 + (temperature - 25) / 20)
+        self.moisture += hours * self.water_rate * watering
+        np.clip(self.moisture, 0, 100, out=self.moisture)
+        self.watered += hours * 3600 * watering
+
+        noise = self.random.normal(0, 0.5, (len(self.zones), 2))
+        readings = {}
+        for i, zone in enumerate(self.zones):
+            readings[zone] = {
+                "temperature": round(temperature + noise[i, 0]),
+                "humidity": round(60 - 2 * (temperature - 24) + noise[i, 1]),
+                "moisture": round(self.moisture[i]),
+            }
+            readings[zone].update(self.recorded.get(zone, {}))
+        return readings
+
+
+class ReplayHarness:
+    """
+    Drives SmartFarm through simulated days as fast as the stages run.
+    Stages are run in order of their simulated start time on a
+    SimulatedClock, against the stub Modbus controller and an in-memory
+    broker.
+    """
+
+    def __init__(self, config, start=None, events=(), seed=0, model=None):
+        """
+        :param config: The parsed config.json.
+        :param start: The datetime the simulation starts at.
+        :param events: (seconds since start, feed, payload) messages to
+            send to the gateway, or (seconds, "soil", readings) to replace
+            the synthetic readings of some zones from then on.
+        :param seed: Seed for the sensor noise and the stub registers.
+        :param model: Watering model, a ThresholdModel if None.
+        """
+        config = copy.deepcopy(config)
+        # No disk and no background threads, everything in step with the
+        # simulated clock
+        config.setdefault("publish", {}).update(background=False, store=None)
+        config.setdefault("history", {})["path"] = None
+        config["display"] = "none"
+        modbus_config = config.get("modbus", {})
+
+        random.seed(seed)
+        self.clock = SimulatedClock(start)
+        self.broker = InMemoryBroker(self.clock)
+        self.stubs = {name: Modbus485_(None) for name in bus_configs(modbus_config)}
+        self.buses = {name: ModbusBus(stub, name) for name, stub in self.stubs.items()}
+        self.controller = SensorRelayController(self.buses, modbus_config)
+        self.farm = SmartFarm(
+            self.controller,
+            "none",
+            clock=self.clock,
+            client=self.broker,
+            model=model or ThresholdModel(),
+            config=config,
+        )
+        self.runtime = self.farm.build_runtime()
+
+        self.events = sorted(events, key=lambda event: event[0])
+        self.field = SyntheticField(self.farm.state.zone_names, seed)
+        # Where each sensor value lives in the stub register maps
+        self.sensor_registers = {}
+        for area, sensor in modbus_config.get(
+            "sensors", SensorRelayController.default_sensors
+        ).items():
+            registers = sensor.get(
+                "registers", SensorRelayController.default_sensor_registers
+            )
+            self.sensor_registers[area] = (
+                self.controller.sensors[area]["bus"],
+                self.controller.sensors[area]["slave"],
+                registers,
+                sensor.get("scale", 1),
+            )
+        # Where each zone's watering relay is
+        self.zone_relays = [
+            self.controller.relays.get(self.farm.actuator.relays.get(zone))
+            for zone in self.farm.state.zone_names
+        ]
+
+    def watering(self):
+        # What the relays really do, not what the gateway thinks
+        return np.array(
+            [
+                relay is not None
+                and self.stubs[relay[0]].registers.get(relay[1:])
+                in (RELAY_ON, COIL_ON)
+                for relay in self.zone_relays
+            ]
+        )
+
+    def update_sensors(self):
+        readings = self.field.step(self.clock.elapsed, self.watering())
+        for area, data in readings.items():
+            if area not in self.sensor_registers:
+                continue
+            bus, slave, registers, scale = self.sensor_registers[area]
+            for name, address in registers.items():
+                value = int(round(data[name] / scale)) & 0xFFFF
+                self.stubs[bus].registers[(slave, address)] = value
+
+    def run(self, days=1):
+        """
+        :return: A summary of the run, see report().
+        """
+        stages = list(self.runtime.stages.values())
+        pending = [(self.clock.elapsed, i) for i in range(len(stages))]
+        heapq.heapify(pending)
+        end = self.clock.elapsed + days * DAY
+        events = list(self.events)
+        started = time.perf_counter()
+
+        while pending:
+            elapsed, i = heapq.heappop(pending)
+            if elapsed >= end:
+                break
+            while events and events[0][0] <= elapsed:
+                at, feed, payload = events.pop(0)
+                self.clock.set(at)
+                if feed == "soil":
+                    for zone, data in payload.items():
+                        self.field.recorded.setdefault(zone, {}).update(data)
+                else:
+                    self.broker.deliver(feed, json.dumps(payload))
+            self.clock.set(elapsed)
+
+            stage = stages[i]
+            if stage.name == "sensors":
+                self.update_sensors()
+            self.runtime.before_stage(stage)
+            try:
+                result = stage.func()
+                if stage.apply is not None:
+                    stage.apply(result)
+            except Exception:
+                stage.errors += 1
+                raise
+            self.runtime.after_stage(stage)
+            stage.runs += 1
+            heapq.heappush(pending, (elapsed + stage.interval, i))
+
+        self.clock.set(end)
+        return self.report(days, time.perf_counter() - started)
+
+    def report(self, days, wall_time):
+        """
+        :return: A dictionary with the simulated and wall time, the tasks
+            completed, seconds each zone was watered, messages published per
+            feed and runs per stage.
+        """
+        published = {}
+        for _, feed, _ in self.broker.published:
+            published[feed] = published.get(feed, 0) + 1
+        return {
+            "days": days,
+            "wall_time": wall_time,
+            "speedup": days * DAY / wall_time if wall_time else math.inf,
+            "tasks": [
+                {
+                    "name": task.get("name"),
+                    "finished": str(self.at(t)),
+                    "cycles_left": task.get("cycle"),
+                }
+                for t, task in self.broker.messages("taskHistory")
+            ],
+            "watered": dict(zip(self.field.zones, self.field.watered.tolist())),
+            "published": published,
+            "stages": {
+                name: stage.runs for name, stage in self.runtime.stages.items()
+            },
+        }
+
+    def at(self, elapsed):
+        return (self.clock.start + timedelta(seconds=elapsed)).replace(microsecond=0)
+
+    def close(self):
+        self.farm.close()
+        for bus in self.buses.values():
+            bus.close()
+
+
+def daily_task_events(task, days):
+    """
+    Send the task at midnight of every simulated day.
+    """
+    return [(day * DAY, "task", dict(task)) for day in range(days)]
+
+
+def load_events(path):
+    """
+    Read recorded events, one JSON object per line with "at" as HH:MM or
+    HH:MM:SS, an optional "day" and either "feed" and "payload" or "soil"
+    readings.
+    """
+    events = []
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            parts = [int(part) for part in event["at"].split(":")]
+            at = event.get("day", 0) * DAY + parts[0] * 3600 + parts[1] * 60
+            if len(parts) > 2:
+                at += parts[2]
+            if "soil" in event:
+                events.append((at, "soil", event["soil"]))
+            else:
+                events.append((at, event["feed"], event["payload"]))
+    return events
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay simulated gateway days")
+    parser.add_argument("--days", type=int, default=1)
+    parser.add_argument("--task", help="Task JSON file sent at midnight every day")
+    parser.add_argument("--events", help="Recorded events, one JSON per line")
+    parser.add_argument("--start", help="Start date, YYYY-MM-DD")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with open("config.json", "r") as f:
+        config = json.load(f)
+
+    events = []
+    if args.task:
+        with open(args.task, "r") as f:
+            events += daily_task_events(json.load(f), args.days)
+    if args.events:
+        events += load_events(args.events)
+    start = datetime.strptime(args.start, "%Y-%m-%d") if args.start else None
+
+    harness = ReplayHarness(config, start, events, args.seed)
+    try:
+        print(json.dumps(harness.run(args.days), indent=4, ensure_ascii=False))
+    finally:
+        harness.close()
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    def __init__(self, name, func, interval, blocking=False, apply=None):
+        """
+        :param name: Name used in overrun reports and config.
+        :param func: Called once per interval without arguments.
+        :param interval: Seconds between the starts of two runs.
+        :param blocking: Run func in a worker thread so slow I/O or inference
+            does not hold up the other stages.
+        :param apply: Called on the event loop with what func returned, so
+            a blocking stage hands its results to the loop instead of
+            changing shared state from the worker thread.
+        """
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.blocking = blocking
+        self.apply = apply
+
+        self.runs = 0
+        self.overruns = 0
+        self.errors = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+
+
+class GatewayRuntime:
+    """
+    Runs each stage on its own period in one asyncio event loop. A stage
+    that takes longer than its interval is reported and its missed runs are
+    skipped instead of queued up.
+    """
+
+    def __init__(self, stages, after_stage=None, before_stage=None):
+        """
+        :param stages: The Stage objects to run.
+        :param after_stage: Called on the event loop with the Stage after
+            each of its runs.
+        :param before_stage: Called on the event loop with the Stage before
+            each of its runs.
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        self.after_stage = after_stage
+        self.before_stage = before_stage
+        self.loop = None
+        self.stopping = None
+        self.stop_requested = False
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.stopping = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        if self.stop_requested:
+            self.stopping.set()
+        tasks = [
+            asyncio.create_task(self._loop(stage), name=stage.name)
+            for stage in self.stages.values()
+        ]
+        await self.stopping.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        # Safe to call from any thread, and before or after the loop ran
+        self.stop_requested = True
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    async def _loop(self, stage):
+        loop = asyncio.get_running_loop()
+        next_run = loop.time()
+        while True:
+            start = time.monotonic()
+            try:
+                if self.before_stage is not None:
+                    self.before_stage(stage)
+                if stage.blocking:
+                    result = await asyncio.to_thread(stage.func)
+                else:
+                    result = stage.func()
+                if stage.apply is not None:
+                    stage.apply(result)
+            except Exception:
+                stage.errors += 1
+                logger.exception("Stage %s failed", stage.name)
+            duration = time.monotonic() - start
+            if self.after_stage is not None:
+                self.after_stage(stage)
+
+            stage.runs += 1
+            stage.last_duration = duration
+            stage.max_duration = max(stage.max_duration, duration)
+            if duration > stage.interval:
+                stage.overruns += 1
+                logger.warning(
+                    "Stage %s overran: %.3f s for a %s s interval",
+                    stage.name,
+                    duration,
+                    stage.interval,
+                )
+
+            next_run += stage.interval
+            now = loop.time()
+            if next_run < now:
+                next_run = now
+            await asyncio.sleep(next_run - now)
+
+    def stats(self):
+        return {
+            name: {
+                "interval": stage.interval,
+                "runs": stage.runs,
+                "overruns": stage.overruns,
+                "errors": stage.errors,
+                "last_duration": stage.last_duration,
+                "max_duration": stage.max_duration,
+            }
+            for name, stage in self.stages.items()
+        }
@@ -0,0 +1,223 @@
+import heapq
+import itertools
+import time
+from datetime import datetime
+
+TIME_FORMAT = "%H:%M"
+
+
+class ScheduledTask:
+    __slots__ = ("id", "data", "start", "end", "version")
+
+    def __init__(self, id, data, version):
+        """
+        :param data: The task as received, with "startTime" and "endTime"
+            as HH:MM strings.
+        """
+        self.id = id
+        self.data = data
+        # Parsed once here instead of on every tick
+        self.start = datetime.strptime(data["startTime"], TIME_FORMAT).time()
+        self.end = datetime.strptime(data["endTime"], TIME_FORMAT).time()
+        self.version = version
+
+
+class TaskScheduler:
+    """
+    Pending tasks in a heap ordered by start time, with an index by id.
+    Cancelled and rescheduled tasks leave their old heap entry behind, it is
+    skipped when it reaches the top. Not thread-safe, only the control loop
+    uses it.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.tasks = {}
+        self.ids = itertools.count(1)
+        self.versions = itertools.count()
+        self.listing = None
+        # Changes since the last drain_changes(), see TaskSync
+        self.changes = []
+
+    def __contains__(self, id):
+        return id in self.tasks
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def get(self, id):
+        return self.tasks.get(id)
+
+    def add(self, data):
+        """
+        :param data: The task, an "id" is assigned if it has none.
+        :return: The ScheduledTask.
+        :raise ValueError: If a time is not HH:MM.
+        """
+        if data.get("id") is None:
+            id = str(next(self.ids))
+            while id in self.tasks:
+                id = str(next(self.ids))
+            data["id"] = id
+        if data["id"] in self.tasks:
+            raise ValueError(f"Task {data['id']} already exists")
+        entry = ScheduledTask(data["id"], data, next(self.versions))
+        self.tasks[entry.id] = entry
+        self._push(entry)
+        self.changes.append({"op": "add", "task": dict(data)})
+        return entry
+
+    def update(self, id, changes):
+        """
+        Change fields of a task, a pending task is rescheduled if its start
+        time changed.
+        :return: The ScheduledTask, or None if there is no such task.
+        :raise ValueError: If a time is not HH:MM.
+        """
+        entry = self.tasks.get(id)
+        if entry is None:
+            return None
+        data = dict(entry.data)
+        data.update(changes)
+        data["id"] = id
+        active = data.get("isActive", False)
+        updated = ScheduledTask(id, data, next(self.versions))
+        fields = {
+            key: value
+            for key, value in data.items()
+            if key not in entry.data or entry.data[key] != value
+        }
+        if fields:
+            self.changes.append({"op": "update", "id": id, "fields": fields})
+        # Keep the dictionary, the running task holds on to it
+        entry.data.clear()
+        entry.data.update(data)
+        updated.data = entry.data
+        self.tasks[id] = updated
+        if not active:
+            self._push(updated)
+        else:
+            self.listing = None
+        return updated
+
+    def cancel(self, id):
+        """
+        :return: The removed ScheduledTask, or None if there is no such task.
+        """
+        entry = self.tasks.pop(id, None)
+        if entry is not None:
+            self.listing = None
+            self.changes.append({"op": "remove", "id": id})
+        return entry
+
+    # A task that finished is removed the same way
+    finish = cancel
+
+    def pop_due(self, now):
+        """
+        Take the next task off the schedule if it should have started.
+        It stays in the index, it is finished or cancelled by id.
+        :param now: A datetime.time.
+        :return: The ScheduledTask, or None if nothing is due.
+        """
+        entry = self.peek()
+        if entry is None or entry.start > now:
+            return None
+        heapq.heappop(self.heap)
+        return entry
+
+    def peek(self):
+        while self.heap:
+            _, version, id = self.heap[0]
+            entry = self.tasks.get(id)
+            if entry is not None and entry.version == version:
+                return entry
+            heapq.heappop(self.heap)
+        return None
+
+    def list(self):
+        """
+        :return: The task dictionaries ordered by start time, as published
+            on the taskList feed.
+        """
+        if self.listing is None:
+            entries = sorted(self.tasks.values(), key=lambda e: (e.start, e.version))
+            self.listing = [entry.data for entry in entries]
+        return self.listing
+
+    def drain_changes(self):
+        """
+        :return: The add, update and remove operations since the last call,
+            oldest first.
+        """
+        changes = self.changes
+        self.changes = []
+        return changes
+
+    def _push(self, entry):
+        heapq.heappush(self.heap, (entry.start, entry.version, entry.id))
+        self.listing = None
+        if len(self.heap) > 2 * len(self.tasks) + 64:
+            # Mostly stale entries, rebuild from the live tasks
+            self.heap = [
+                (e.start, e.version, e.id)
+                for e in self.tasks.values()
+                if not e.data.get("isActive", False)
+            ]
+            heapq.heapify(self.heap)
+
+
+class TaskSync:
+    """
+    Publishes schedule changes on the taskSync feed as numbered add, update
+    and remove operations, so a change costs the same however many tasks
+    are queued. The full list goes out on the taskList feed when requested,
+    or at most every interval seconds if the schedule changed, followed by
+    a snapshot operation with the sequence number the list is current to.
+    """
+
+    def __init__(self, scheduler, publisher, interval=60, clock=None):
+        """
+        :param scheduler: The TaskScheduler to follow.
+        :param publisher: A FeedPublisher.
+        :param interval: Least seconds between two periodic snapshots.
+        :param clock: Returns seconds for the interval, time.monotonic if
+            None.
+        """
+        self.scheduler = scheduler
+        self.publisher = publisher
+        self.interval = interval
+        self.clock = clock or time.monotonic
+        self.seq = 0
+        self.last_snapshot = None
+        # Sequence number of the last snapshot, the first flush sends one
+        self.snapshot_seq = None
+        self.requested = True
+
+    def request_snapshot(self):
+        # Sent on the next flush()
+        self.requested = True
+
+    def flush(self):
+        ops = self.scheduler.drain_changes()
+        if ops:
+            for op in ops:
+                self.seq += 1
+                op["seq"] = self.seq
+            self.publisher.publish("taskSync", ops, force=True)
+
+        now = self.clock()
+        if not self.requested and (
+            self.seq == self.snapshot_seq or now - self.last_snapshot < self.interval
+        ):
+            return
+        # Unless requested, an unchanged list is left to the publisher's
+        # change detection
+        if self.publisher.publish(
+            "taskList", self.scheduler.list(), force=self.requested
+        ):
+            snapshot = {"op": "snapshot", "seq": self.seq}
+            self.publisher.publish("taskSync", [snapshot], force=True)
+        self.last_snapshot = now
+        self.snapshot_seq = self.seq
+        self.requested = False
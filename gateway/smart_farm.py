@@ -1,125 +1,153 @@
+import argparse
+import collections
+import concurrent.futures
+import copy
 import json
+import logging
 import os
 import queue
+import random
+import signal
 import sys
+import threading
 import time
 import warnings
-from datetime import datetime
+from datetime import datetime, timezone
+
+import numpy as np
+from Adafruit_IO import Client, Data, MQTTClient
+
+from actuation import RelayActuator
+from clock import SystemClock
+from display import create_display
+from history import HistoryStore
+from logs import setup_logging
+from modbus import SensorRelayController, open_buses
+from publisher import FeedPublisher, PublishQueue
+from runtime import GatewayRuntime, Stage
+from scheduler import TaskScheduler, TaskSync
+from zones import FarmState
 
-import pygame
-import serial
-from Adafruit_IO import MQTTClient
+warnings.filterwarnings("ignore")
 
-from modbus import Modbus485, Modbus485_, SensorRelayController
-from watering.test import WateringPredictionModel
+logger = logging.getLogger(__name__)
 
-warnings.filterwarnings("ignore")
+StateSnapshot = collections.namedtuple(
+    "StateSnapshot", ["version", "state", "task", "lines"]
+)
 
 
 class SmartFarm:
-    def __init__(self, controller):
-        # Save the current stdout
-        self.original_stdout = sys.stdout
-        # Redirect stdout to devnull
-        sys.stdout = open(os.devnull, "w")
-
-        # Watering model
-        dir = "watering"
-        model_path = os.path.join(dir, "watering_prediction_model.h5")
-        scaler_path = os.path.join(dir, "scaler.pkl")
-        self.wateringModel = WateringPredictionModel(model_path, scaler_path)
+    def __init__(
+        self, controller, display=None, clock=None, client=None, model=None, config=None
+    ):
+        """
+        :param controller: The SensorRelayController.
+        :param display: Display sink, overrides the one in config.
+        :param clock: Time source, a SystemClock if None. The replay harness
+            passes a SimulatedClock.
+        :param client: MQTT client, an Adafruit IO MQTTClient if None.
+        :param model: Watering model, the trained one is loaded in the
+            background if None.
+        :param config: The parsed config.json, read from disk if None.
+        """
+        start = time.monotonic()
+        self.startup_times = {}
+        self.clock = clock or SystemClock()
+
+        # Watering model, TensorFlow takes seconds to import so it loads in
+        # the background and watering predictions start once it is ready
+        self.wateringModel = model
+        if model is None:
+            threading.Thread(
+                target=self.load_model, name="model", daemon=True
+            ).start()
+
+        if config is None:
+            with open("config.json", "r") as f:
+                config = json.load(f)
 
         self.controller = controller
+        actuation = config.get("actuation", {})
+        self.actuator = RelayActuator(
+            controller,
+            actuation.get("relays"),
+            actuation.get("verify_interval", 300),
+            self.clock.monotonic,
+        )
+        self.intervals = config.get("intervals", {})
+        self.display_mode = display or config.get("display", "pygame")
+        self.display_fps = config.get("display_fps", 30)
 
-        self.taskList = []
+        self.scheduler = TaskScheduler()
+        # Messages from the MQTT thread, only the control loop changes state
+        self.commands = queue.SimpleQueue()
         self.task = None
-        self.done = set()
-
-        self.soilData = {
-            "area1": {
-                "temperature": 0,
-                "humidity": 0,
-                "moisture": 0,
-            },
-            "area2": {
-                "temperature": 0,
-                "humidity": 0,
-                "moisture": 0,
-            },
-            "area3": {
-                "temperature": 0,
-                "humidity": 0,
-                "moisture": 0,
-            },
-        }
-
-        self.levelData = {
-            "water": 100,
-            "mixer1": 0,
-            "mixer2": 0,
-            "mixer3": 0,
-        }
-
-        self.monitorData = {
-            "automatic": True,
-            "watering": {
-                "area1": False,
-                "area2": False,
-                "area3": False,
-            },
-            "mixer": {
-                "mixer1": False,
-                "mixer2": False,
-                "mixer3": False,
-            },
-            "pump": {
-                "pumpin": False,
-                "pumpout": False,
-            },
-        }
+        # Emptying the mixers into the pipes after they were filled
+        self.draining = False
 
-        # Inittialize relay and sensor data
-        self.controller.control_relay(1, False)
-        self.controller.control_relay(2, False)
-        self.controller.control_relay(3, False)
-        self.controller.control_relay(4, False)
-        self.controller.control_relay(5, False)
-        self.controller.control_relay(6, False)
-        self.controller.control_relay(7, False)
-        self.controller.control_relay(8, False)
-
-        for area in self.soilData:
-            (
-                self.soilData[area]["temperature"],
-                self.soilData[area]["humidity"],
-                self.soilData[area]["moisture"],
-            ) = self.controller.get_soil_data()
-
-        for area in self.soilData:
-            input_data = {
-                "Soil Moisture": self.soilData[area]["moisture"],
-                "Temperature": self.soilData[area]["temperature"],
-                "Soil Humidity": self.soilData[area]["humidity"],
-            }
-            if self.monitorData["automatic"]:
-                prediction = self.wateringModel.preprocess_and_predict(input_data)
-                self.monitorData["watering"][area] = True if prediction == 1 else False
+        # Zones, mixers and pumps come from config
+        self.state = FarmState.from_config(config.get("farm", {}))
+        self.history = HistoryStore.from_config(
+            self.state.history_series(), config.get("history", {})
+        )
 
         # Initialize Adafruit IO
-        with open("config.json", "r") as f:
-            config = json.load(f)
-
         self.feeds = config["feeds"]
 
-        client = MQTTClient(config["username"], "".join(config["key"]))
+        self.rest = None
+        if client is None:
+            key = "".join(config["key"])
+            client = MQTTClient(config["username"], key)
+            # Messages stored during an outage are backfilled over REST,
+            # MQTT cannot say when a value was measured
+            self.rest = Client(config["username"], key)
         client.on_connect = self.connected
         client.on_disconnect = self.disconnected
         client.on_message = self.message
         client.on_subscribe = self.subscribe
-        client.connect()
-        client.loop_background()
         self.client = client
-        time.sleep(5)
+        publish = config.get("publish", {})
+        if publish.get("background", True):
+            # Sends from its own thread, publishing never waits on the broker.
+            # Ready before connecting, the callbacks switch it on and off
+            self.outbox = PublishQueue.from_config(
+                client, publish, self.send_batch if self.rest is not None else None
+            ).start()
+        else:
+            # Straight to the client, replays keep messages in step with
+            # the simulated clock
+            self.outbox = None
+        self.publisher = FeedPublisher(
+            self.outbox or client,
+            publish.get("deadbands"),
+            publish.get("heartbeat", 300),
+            self.clock.monotonic,
+            echo_feeds=("monitor",),
+        )
+        self.task_sync = TaskSync(
+            self.scheduler,
+            self.publisher,
+            publish.get("task_snapshot_interval", 60),
+            self.clock.monotonic,
+        )
+        self.reconnect_delay = publish.get("reconnect_delay", [1, 300])
+        self.broker_online = False
+        self.network_stop = threading.Event()
+        self.connect_timeout = publish.get("connect_timeout", 10)
+        self.subscriptions = 0
+        self.subscribed = threading.Event()
+
+        # Relays, sensors and the broker connection come up side by side,
+        # the window opens meanwhile
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="startup"
+        ) as pool:
+            hardware = pool.submit(self.timed, "hardware", self.init_hardware)
+            broker = pool.submit(self.timed, "broker", self.connect_broker)
+            self.display = self.timed("display", create_display, self.display_mode)
+            hardware.result()
+            broker.result()
 
         # Publish relay and sensor data to Adafruit IO
         # relayValue = {
@@ -134,302 +162,452 @@ class SmartFarm:
         # }
         # self.client.publish("relay", json.dumps(relayValue))
 
-        soilValue = {
-            "area1": self.soilData["area1"],
-            "area2": self.soilData["area2"],
-            "area3": self.soilData["area3"],
-        }
-        self.client.publish("soil", json.dumps(soilValue))
-
-        levelValue = {
-            "water": self.levelData["water"],
-            "mixer1": self.levelData["mixer1"],
-            "mixer2": self.levelData["mixer2"],
-            "mixer3": self.levelData["mixer3"],
-        }
-        self.client.publish("level", json.dumps(levelValue))
-
-        monitorValue = {
-            "automatic": self.monitorData["automatic"],
-            "watering": self.monitorData["watering"],
-            "mixer": self.monitorData["mixer"],
-            "pump": self.monitorData["pump"],
-        }
-        self.client.publish("monitor", json.dumps(monitorValue))
-
-        self.init_pygame()
-        self.load_assets()
+        self.snapshot = None
+        self.update_snapshot()
+        self.publish_data()
+
+        self.startup_times["total"] = time.monotonic() - start
+        logger.info(
+            "Startup: %s",
+            ", ".join(
+                f"{name} {seconds:.2f} s"
+                for name, seconds in self.startup_times.items()
+            ),
+        )
+
+    def timed(self, name, func, *args):
+        start = time.monotonic()
+        result = func(*args)
+        self.startup_times[name] = time.monotonic() - start
+        return result
+
+    def load_model(self):
+        start = time.monotonic()
+        # Keep TensorFlow's C++ info and warning messages out of the output
+        os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+        try:
+            from watering.test import WateringPredictionModel
+
+            dir = "watering"
+            model_path = os.path.join(dir, "watering_prediction_model.h5")
+            scaler_path = os.path.join(dir, "scaler.pkl")
+            self.wateringModel = WateringPredictionModel(model_path, scaler_path)
+        except Exception:
+            logger.exception("Loading the watering model failed")
+            return
+        logger.info("Watering model loaded in %.2f s", time.monotonic() - start)
+
+    def init_hardware(self):
+        # Inittialize relay and sensor data
+        self.actuator.apply(self.relay_states())
+        self.poll_sensors()
+
+    def connect_broker(self):
+        threading.Thread(target=self.run_network, name="mqtt", daemon=True).start()
+        # Subscribed to every feed, so no command sent meanwhile is missed
+        if not self.subscribed.wait(self.connect_timeout):
+            logger.warning(
+                "Not subscribed after %s s, continuing", self.connect_timeout
+            )
+
+    def run_network(self):
+        # The only thread that connects, it runs the client's network loop
+        # instead of loop_background(), whose thread would reconnect on its
+        # own and tear down our attempts. The Adafruit client raises from
+        # its disconnect callback when the connection drops, so the loop
+        # notices the drop by polling is_connected()
+        delay, max_delay = self.reconnect_delay
+        first = True
+        while not self.network_stop.is_set():
+            if self.client.is_connected():
+                self.poll_network()
+                continue
+            self.disconnected(self.client)
+            if not first:
+                # Jitter keeps gateways that lost the broker together from
+                # all coming back at the same moment
+                self.network_stop.wait(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, max_delay)
+            first = False
+            if self.connect():
+                delay = self.reconnect_delay[0]
+
+    def connect(self):
+        """
+        :return: True once the broker accepted the connection.
+        """
+        try:
+            self.client.connect()
+        except OSError as e:
+            logger.warning("Connecting failed: %r", e)
+            return False
+        # The broker's answer is handled in the network loop
+        deadline = time.monotonic() + self.connect_timeout
+        while not self.client.is_connected() and time.monotonic() < deadline:
+            self.poll_network()
+        return self.client.is_connected()
+
+    def poll_network(self):
+        try:
+            self.client.loop(1.0)
+        except Exception as e:
+            # MQTTError for a dropped or refused connection
+            logger.debug("Network loop: %r", e)
+
+    def send_batch(self, feed, rows):
+        # Runs on the outbox thread, rows are (time queued, payload)
+        self.rest.send_batch_data(
+            feed,
+            [
+                Data(
+                    value=payload,
+                    created_at=datetime.fromtimestamp(
+                        created, timezone.utc
+                    ).isoformat(),
+                )
+                for created, payload in rows
+            ],
+        )
 
     def connected(self, client):
-        print("Connected ...")
+        logger.info("Connected to the broker")
+        self.broker_online = True
+        self.subscriptions = 0
         for feed in self.feeds:
             client.subscribe(feed)
+        if self.outbox is not None:
+            self.outbox.set_online(True)
 
     def subscribe(self, client, userdata, mid, granted_qos):
-        print("Subscribeb...")
+        logger.debug("Subscribed, message %s", mid)
+        self.subscriptions += 1
+        if self.subscriptions >= len(self.feeds):
+            self.subscribed.set()
 
     def disconnected(self, client):
-        print("Disconnected...")
-        sys.exit(1)
+        if not self.broker_online:
+            return
+        logger.warning("Disconnected from the broker")
+        self.broker_online = False
+        # Keep running on local data, messages are stored until reconnected
+        if self.outbox is not None:
+            self.outbox.set_online(False)
 
     def message(self, client, feed_id, payload):
-        # Restore the original stdout
-        sys.stdout = self.original_stdout
-        print("Received: " + payload + " from " + feed_id)
-        # Redirect stdout to devnull
-        sys.stdout = open(os.devnull, "w")
+        logger.debug("Received %s from %s", payload, feed_id)
+
+        # Other subscribed feeds only echo what the gateway published
+        if feed_id not in ("task", "monitor"):
+            return
+        # The state the gateway published on monitor comes back too, applied
+        # late it would undo flags changed since, e.g. by a prediction
+        if self.publisher.is_echo(feed_id, payload):
+            return
+        # Runs on the MQTT thread, the control loop applies it at the start
+        # of its next stage
+        try:
+            data = json.loads(payload)
+        except ValueError as e:
+            logger.warning("Invalid %s message: %r", feed_id, e)
+            return
+        if not isinstance(data, dict):
+            logger.warning("Invalid %s message: not an object", feed_id)
+            return
+        self.commands.put((feed_id, data))
+
+    def drain_commands(self, stage=None):
+        while True:
+            try:
+                feed_id, data = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            # A bad command must not stop the stage it runs in front of
+            try:
+                self.handle_command(feed_id, data)
+            except Exception:
+                logger.exception("Applying a %s command failed", feed_id)
 
+    def handle_command(self, feed_id, data):
         if feed_id == "task":
-            task = json.loads(payload)
-            self.taskList.append(task)
-            self.taskList = sorted(self.taskList, key=lambda x: x["startTime"])
+            task = data
+            # A plain task is added, {"action": "cancel" or "update", "id": ...}
+            # changes one that was added before and {"action": "snapshot"}
+            # asks for the full task list
+            action = task.pop("action", "add")
+            try:
+                if action == "snapshot":
+                    self.task_sync.request_snapshot()
+                elif action == "cancel":
+                    self.scheduler.cancel(task["id"])
+                elif action == "update":
+                    self.scheduler.update(task.pop("id"), task)
+                else:
+                    self.scheduler.add(task)
+            except (KeyError, ValueError) as e:
+                logger.warning("Invalid task %s: %r", action, e)
 
         elif feed_id == "monitor":
-            monitorData = json.loads(payload)
-            for key in monitorData:
-                if key == "automatic":
-                    self.monitorData["automatic"] = monitorData["automatic"]
-                if key == "watering":
-                    for area, value in monitorData["watering"].items():
-                        self.monitorData["watering"][area] = value
-                if key == "mixer":
-                    for mixer, value in monitorData["mixer"].items():
-                        self.monitorData["mixer"][mixer] = value
-                if key == "pump":
-                    for pump, value in monitorData["pump"].items():
-                        self.monitorData["pump"][pump] = value
-
-    def init_pygame(self):
-        pygame.init()
-        self.screen = pygame.display.set_mode((1200, 680))
-        pygame.display.set_caption("Smart Farm Monitor")
-        self.font = pygame.font.Font("DejaVuSans.ttf", 36)
-        self.clock = pygame.time.Clock()
-
-    def load_assets(self):
-        self.background_color = (0, 0, 0)
+            self.state.apply_flags(data)
 
     def update_task(self):
+        current_time = self.clock.now().time()
         if self.task is None:
-            if len(self.taskList) > 0:
-                current_time = datetime.now().time()
-                task_time = datetime.strptime(
-                    self.taskList[0]["startTime"], "%H:%M"
-                ).time()
-                if current_time >= task_time:
-                    self.task = self.taskList[0]
-                    self.task["isActive"] = True
-                    self.monitorData["pump"]["pumpin"] = True
-                    self.client.publish(
-                        "taskList", json.dumps(self.taskList, ensure_ascii=False)
-                    )
-                    return
-        else:
-            end_time = datetime.strptime(self.task["endTime"], "%H:%M").time()
-            current_time = datetime.now().time()
-            if current_time >= end_time:
-                self.client.publish(
-                    "taskHistory", json.dumps(self.task, ensure_ascii=False)
-                )
-                self.remove_task(self.task)
-                self.task = None
-                self.done = set()
-                self.monitorData["pump"]["pumpin"] = False
-                self.monitorData["pump"]["pumpout"] = False
-                self.monitorData["mixer"]["mixer1"] = False
-                self.monitorData["mixer"]["mixer2"] = False
-                self.monitorData["mixer"]["mixer3"] = False
-                self.levelData["mixer1"] = 0
-                self.levelData["mixer2"] = 0
-                self.levelData["mixer3"] = 0
-                self.client.publish(
-                    "taskList", json.dumps(self.taskList, ensure_ascii=False)
-                )
-                return
-            for mixer in self.task["task"]:
-                if self.task["task"][mixer] > self.levelData[mixer]:
-                    if not self.monitorData["mixer"][mixer]:
-                        self.monitorData["mixer"][mixer] = True
-                    self.levelData[mixer] += 10
-                    self.levelData["water"] -= 1
-                else:
-                    self.monitorData["mixer"][mixer] = False
-                    self.done.add(mixer)
-            if len(self.done) < 3:
-                self.client.publish(
-                    "taskList", json.dumps(self.taskList, ensure_ascii=False)
-                )
-                return
-            if len(self.done) == 3:
-                self.monitorData["pump"]["pumpin"] = False
-                self.monitorData["pump"]["pumpout"] = True
-                self.done.add("pump")
-                self.client.publish(
-                    "taskList", json.dumps(self.taskList, ensure_ascii=False)
-                )
-                return
-            if len(self.done) == 4:
-                self.levelData["mixer1"] = 0
-                self.levelData["mixer2"] = 0
-                self.levelData["mixer3"] = 0
-                self.done = set()
-                self.task["cycle"] -= 1
-                if self.task["cycle"] == 0:
-                    self.client.publish(
-                        "taskHistory", json.dumps(self.task, ensure_ascii=False)
-                    )
-                    self.remove_task(self.task)
-                    self.task = None
-                    self.monitorData["pump"]["pumpin"] = False
-                    self.monitorData["pump"]["pumpout"] = False
-                    self.monitorData["mixer"]["mixer1"] = False
-                    self.monitorData["mixer"]["mixer2"] = False
-                    self.monitorData["mixer"]["mixer3"] = False
-                    self.client.publish(
-                        "taskList", json.dumps(self.taskList, ensure_ascii=False)
-                    )
-                    return
-                self.monitorData["pump"]["pumpin"] = True
-                self.monitorData["pump"]["pumpout"] = False
-                self.monitorData["mixer"]["mixer1"] = False
-                self.monitorData["mixer"]["mixer2"] = False
-                self.monitorData["mixer"]["mixer3"] = False
-                self.client.publish(
-                    "taskList", json.dumps(self.taskList, ensure_ascii=False)
-                )
+            entry = self.scheduler.pop_due(current_time)
+            if entry is not None:
+                self.task = entry.data
+                self.scheduler.update(entry.id, {"isActive": True})
+                self.state.set_pumps(True, False)
+            return
+
+        entry = self.scheduler.get(self.task["id"])
+        if entry is None:
+            # Cancelled while running
+            self.end_task()
+            return
+        if current_time >= entry.end:
+            self.publisher.publish("taskHistory", self.task, force=True)
+            self.end_task()
+            return
+        if self.state.fill_mixers(self.task["task"]):
+            return
+        if not self.draining:
+            self.state.set_pumps(False, True)
+            self.draining = True
+            return
+
+        # Drained, start the next cycle
+        self.state.reset_mixers()
+        self.draining = False
+        self.scheduler.update(self.task["id"], {"cycle": self.task["cycle"] - 1})
+        if self.task["cycle"] == 0:
+            self.publisher.publish("taskHistory", self.task, force=True)
+            self.end_task()
+            return
+        self.state.set_pumps(True, False)
+
+    def run_tasks(self):
+        self.update_task()
+        self.task_sync.flush()
+
+    def end_task(self):
+        self.scheduler.finish(self.task["id"])
+        self.task = None
+        self.draining = False
+        self.state.set_pumps(False, False)
+        self.state.reset_mixers()
+
+    def relay_states(self):
+        return self.state.relay_states()
+
+    def update_relays(self):
+        # Worker thread, the snapshot is never changed so it is safe to read
+        self.actuator.apply(self.snapshot.state.relay_states())
+
+    def poll_sensors(self):
+        self.state.set_readings(self.read_sensors())
+
+    def read_sensors(self):
+        # Only the bus I/O, set_readings() applies the result on the loop
+        return self.controller.sweep_soil_data()
+
+    def predict_watering(self):
+        """
+        Runs in a worker thread, reads only the snapshot.
+        :return: The watering flag of every zone, or None without a
+            prediction.
+        """
+        if self.wateringModel is None:
+            # Still loading
+            return None
+        state = self.snapshot.state
+        if not state.automatic:
+            return None
+        # One model call for all zones
+        return self.wateringModel.predict_batch(state.features())
+
+    def update_watering(self, predictions):
+        # Automatic mode may have been switched off while the model ran
+        if predictions is not None and self.state.automatic:
+            self.state.zones["watering"] = predictions
+
+        self.state.water -= int(np.count_nonzero(self.state.zones["watering"]))
+        if self.state.water <= 50:
+            self.state.water = 100
+
+    def record_history(self):
+        self.history.append(self.state.history_row(), self.clock.time())
+
+    def publish_data(self):
+        state = self.snapshot.state
+        self.publisher.publish("soil", state.soil())
+        self.publisher.publish("level", state.level())
+        self.publisher.publish("monitor", state.monitor())
 
-    def remove_task(self, task):
-        for i, t in enumerate(self.taskList):
-            if t is task:
-                del self.taskList[i]
-                break
+    def display_data(self):
+        self.display.show(self.snapshot.lines)
+
+    def display_lines(self, snapshot):
+        state = snapshot.state
+        lines = []
+        for area, data in zip(state.zone_names, state.zones):
+            lines.append(
+                f"{area.upper()}: Temp={data['temperature']:g}°C, "
+                + f"Humidity={data['humidity']:g}%, Moisture={data['moisture']:g}%"
+            )
 
-    def update_data(self):
-        for area in self.soilData:
-            (
-                self.soilData[area]["temperature"],
-                self.soilData[area]["humidity"],
-                self.soilData[area]["moisture"],
-            ) = self.controller.get_soil_data()
-
-        for area in self.soilData:
-            input_data = {
-                "Soil Moisture": self.soilData[area]["moisture"],
-                "Temperature": self.soilData[area]["temperature"],
-                "Soil Humidity": self.soilData[area]["humidity"],
-            }
-            if self.monitorData["automatic"]:
-                prediction = self.wateringModel.preprocess_and_predict(input_data)
-                self.monitorData["watering"][area] = True if prediction == 1 else False
-
-        for area in self.monitorData["watering"]:
-            if self.monitorData["watering"][area]:
-                self.levelData["water"] -= 1
-        if self.levelData["water"] <= 50:
-            self.levelData["water"] = 100
-
-        soilValue = {
-            "area1": self.soilData["area1"],
-            "area2": self.soilData["area2"],
-            "area3": self.soilData["area3"],
-        }
-        self.client.publish("soil", json.dumps(soilValue))
-
-        levelValue = {
-            "water": self.levelData["water"],
-            "mixer1": self.levelData["mixer1"],
-            "mixer2": self.levelData["mixer2"],
-            "mixer3": self.levelData["mixer3"],
-        }
-        self.client.publish("level", json.dumps(levelValue))
-
-        monitorValue = {
-            "automatic": self.monitorData["automatic"],
-            "watering": self.monitorData["watering"],
-            "mixer": self.monitorData["mixer"],
-            "pump": self.monitorData["pump"],
-        }
-        self.client.publish("monitor", json.dumps(monitorValue))
+        lines.append(f"Automatic Mode: {state.automatic}")
 
-    def display_data(self):
-        self.screen.fill(self.background_color)
-        y_offset = 20
-        for area, data in self.soilData.items():
-            text = (
-                f"{area.upper()}: Temp={data['temperature']}°C, Humidity={data['humidity']}%, "
-                + f"Moisture={data['moisture']}%"
+        for area, watering in zip(state.zone_names, state.zones["watering"]):
+            lines.append(f"{area.upper()} Watering: {watering}")
+
+        lines.append(f"Water Level={state.water}%")
+        lines.append(
+            ", ".join(
+                f"{mixer.capitalize()} Level={level}%"
+                for mixer, level in zip(state.mixer_names, state.mixers["level"])
             )
-            self.render_text(text, 20, y_offset)
-            y_offset += 50
-
-        text = f"Automatic Mode: {self.monitorData['automatic']}"
-        self.render_text(text, 20, y_offset)
-        y_offset += 50
-
-        for area, data in self.monitorData["watering"].items():
-            text = f"{area.upper()} Watering: {data}"
-            self.render_text(text, 20, y_offset)
-            y_offset += 50
-
-        level_status = [
-            f"Water Level={self.levelData['water']}%",
-            f"Mixer1 Level={self.levelData['mixer1']}%, Mixer2 Level={self.levelData['mixer2']}%, "
-            + f"Mixer3 Level={self.levelData['mixer3']}%",
-        ]
-        for status in level_status:
-            self.render_text(status, 20, y_offset)
-            y_offset += 50
-
-        relay_status = [
-            f"Pump In={self.monitorData['pump']['pumpin']}, Pump Out={self.monitorData['pump']['pumpout']}",
-            f"Mixer1={self.monitorData['mixer']['mixer1']}, Mixer2={self.monitorData['mixer']['mixer2']}, "
-            + f"Mixer3={self.monitorData['mixer']['mixer3']}",
-        ]
-        for status in relay_status:
-            self.render_text(status, 20, y_offset)
-            y_offset += 50
+        )
+
+        lines.append(f"Pump In={state.pumps[0]}, Pump Out={state.pumps[1]}")
+        lines.append(
+            ", ".join(
+                f"{mixer.capitalize()}={on}"
+                for mixer, on in zip(state.mixer_names, state.mixers["on"])
+            )
+        )
 
         task_status = (
-            f"Current task: {self.task['name']}"
-            if self.task is not None
+            f"Current task: {snapshot.task['name']}"
+            if snapshot.task is not None
             else "No task!"
         )
-        self.render_text(task_status, 20, y_offset)
-
-    def render_text(self, text, x, y):
-        text_surface = self.font.render(text, True, (255, 255, 255))
-        self.screen.blit(text_surface, (x, y))
-
-    def run_pygame_loop(self):
-        running = True
-        while running:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    running = False
-
-            self.update_task()
-            self.update_data()
+        lines.append(task_status)
+        return lines
+
+    def update_snapshot(self, stage=None):
+        # Runs on the control loop after every stage. Readers only ever get
+        # a copy that is never changed again, a new version replaces it
+        # when the state changed
+        task = copy.deepcopy(self.task)
+        previous = self.snapshot
+        if (
+            previous is not None
+            and previous.task == task
+            and previous.state == self.state
+        ):
+            return
+        version = previous.version + 1 if previous is not None else 0
+        snapshot = StateSnapshot(version, self.state.copy(readonly=True), task, ())
+        self.snapshot = snapshot._replace(lines=tuple(self.display_lines(snapshot)))
+
+    def run_display(self, control):
+        # Pump window events and draw at frame rate, however long the
+        # control stages take
+        frame_time = 1.0 / self.display_fps
+        next_frame = time.monotonic()
+        while control.is_alive():
+            if not self.display.poll():
+                break
             self.display_data()
-            pygame.display.flip()
-            # self.clock.tick(30)
-            pygame.time.delay(10000)
 
-        pygame.quit()
-        sys.exit()
+            next_frame += frame_time
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_frame = time.monotonic()
+
+    def build_runtime(self):
+        # Each stage runs on its own period, sensor I/O, inference and relay
+        # writes in worker threads so they never delay publishing. The
+        # threads only read the snapshot, their results are applied to the
+        # state on the loop
+        intervals = self.intervals
+        stages = [
+            Stage(
+                "sensors",
+                self.read_sensors,
+                intervals.get("sensors", 10),
+                blocking=True,
+                apply=self.state.set_readings,
+            ),
+            Stage(
+                "watering",
+                self.predict_watering,
+                intervals.get("watering", 10),
+                blocking=True,
+                apply=self.update_watering,
+            ),
+            Stage("task", self.run_tasks, intervals.get("task", 10)),
+            Stage(
+                "actuation",
+                self.update_relays,
+                intervals.get("actuation", 1),
+                blocking=True,
+            ),
+            Stage("publish", self.publish_data, intervals.get("publish", 10)),
+            Stage("history", self.record_history, intervals.get("history", 10)),
+            Stage(
+                "history_flush",
+                self.history.flush,
+                intervals.get("history_flush", 300),
+                blocking=True,
+            ),
+        ]
+        return GatewayRuntime(stages, self.update_snapshot, self.drain_commands)
+
+    def close(self):
+        self.network_stop.set()
+        self.history.flush()
+        if self.outbox is not None:
+            self.outbox.stop()
 
     def start(self):
-        self.run_pygame_loop()
+        self.runtime = self.build_runtime()
+        # docker stop and systemd send SIGTERM, stop the stages so the
+        # history, outbox and log records are flushed like on Ctrl-C
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.runtime.stop())
+        if self.display_mode == "none":
+            # Stopped by Ctrl-C or SIGTERM, flush on the way out
+            try:
+                self.runtime.run()
+            finally:
+                self.close()
+            sys.exit()
+
+        # The window has to be driven from the main thread, so the control
+        # loop moves to the background
+        control = threading.Thread(target=self.runtime.run, name="control")
+        control.start()
+        try:
+            self.run_display(control)
+        finally:
+            self.runtime.stop()
+            control.join()
+            self.close()
+            self.display.close()
+        sys.exit()
 
 
 if __name__ == "__main__":
-    try:
-        ser = serial.Serial(port="/dev/ttyUSB0", baudrate=9600)
-    except Exception as e:
-        ser = None
-        print("Modbus485: Failed to open port:", e)
+    parser = argparse.ArgumentParser(description="Smart farm gateway")
+    parser.add_argument(
+        "--display",
+        choices=["pygame", "terminal", "none"],
+        help="Override the display sink from config.json",
+    )
+    args = parser.parse_args()
+
+    with open("config.json", "r") as f:
+        config = json.load(f)
+    listener = setup_logging(config.get("logging", {}))
+    modbus_config = config.get("modbus", {})
 
-    m485 = Modbus485_(ser)
-    controller = SensorRelayController(m485)
+    try:
+        # Ports that cannot be opened fall back to the in-process stub
+        controller = SensorRelayController(open_buses(modbus_config), modbus_config)
 
-    app = SmartFarm(controller)
-    app.start()
+        app = SmartFarm(controller, args.display)
+        app.start()
+    finally:
+        listener.stop()
@@ -1,4 +1,11 @@
-from modbus import Modbus485
+from modbus import (
+    RELAY_OFF,
+    RELAY_ON,
+    Modbus485,
+    ModbusBus,
+    read_registers_frame,
+    write_register_frame,
+)
 import serial as serial
 import time
 
@@ -7,110 +14,26 @@ try:
 except Exception as e:
     print("Modbus485: Failed to open port:", e)
 
-m485 = Modbus485(ser)
+m485 = ModbusBus(Modbus485(ser))
 
-relay1_ON = [1, 6, 0, 0, 255, 201, 138]
-relay1_OFF = [1, 6, 0, 0, 0, 137, 202]
+relay_ON = {i: write_register_frame(i, 0, RELAY_ON) for i in range(1, 9)}
+relay_OFF = {i: write_register_frame(i, 0, RELAY_OFF) for i in range(1, 9)}
 
-relay2_ON = [2, 6, 0, 0, 255, 201, 185]
-relay2_OFF = [2, 6, 0, 0, 0, 137, 249]
-
-relay3_ON = [3, 6, 0, 0, 255, 200, 104]
-relay3_OFF = [3, 6, 0, 0, 0, 136, 40]
-
-relay4_ON = [4, 6, 0, 0, 255, 201, 223]
-relay4_OFF = [4, 6, 0, 0, 0, 137, 159]
-
-relay5_ON = [5, 6, 0, 0, 255, 200, 144]
-relay5_OFF = [5, 6, 0, 0, 0, 136, 78]
-
-relay6_ON = [6, 6, 0, 0, 255, 200, 61]
-relay6_OFF = [6, 6, 0, 0, 0, 136, 127]
-
-relay7_ON = [7, 6, 0, 0, 255, 201, 236]
-relay7_OFF = [7, 6, 0, 0, 0, 137, 172]
-
-relay8_ON = [8, 6, 0, 0, 255, 201, 19]
-relay8_OFF = [8, 6, 0, 0, 0, 137, 83]
-
-soil_temperature = [10, 3, 0, 6, 0, 1, 101, 112]
-soil_moisture = [10, 3, 0, 7, 0, 1, 52, 176]
+soil_temperature = read_registers_frame(10, 6, 1)
+soil_moisture = read_registers_frame(10, 7, 1)
 
 # Test relay ON/OFF
-m485.modbus485_send(relay1_ON)
-time.sleep(1)
-m485.modbus485_read()
-
-m485.modbus485_send(relay2_ON)
-time.sleep(1)
-m485.modbus485_read()
-
-m485.modbus485_send(relay3_ON)
-time.sleep(1)
-m485.modbus485_read()
-
-m485.modbus485_send(relay4_ON)
-time.sleep(1)
-m485.modbus485_read()
-
-m485.modbus485_send(relay5_ON)
-time.sleep(1)
-m485.modbus485_read()
-
-m485.modbus485_send(relay6_ON)
-time.sleep(1)
-m485.modbus485_read()
-
-m485.modbus485_send(relay7_ON)
-time.sleep(1)
-m485.modbus485_read()
+for i in range(1, 9):
+    print(list(m485.modbus485_transaction(relay_ON[i], 8)))
 
-m485.modbus485_send(relay8_ON)
 time.sleep(1)
-m485.modbus485_read()
-
-
-time.sleep(1)
-m485.modbus485_send(relay1_OFF)
-time.sleep(1)
-m485.modbus485_read()
-
-m485.modbus485_send(relay2_OFF)
-time.sleep(1)
-m485.modbus485_read()
-
-m485.modbus485_send(relay3_OFF)
-time.sleep(1)
-m485.modbus485_read()
-
-m485.modbus485_send(relay4_OFF)
-time.sleep(1)
-m485.modbus485_read()
-
-m485.modbus485_send(relay5_OFF)
-time.sleep(1)
-m485.modbus485_read()
-
-m485.modbus485_send(relay6_OFF)
-time.sleep(1)
-m485.modbus485_read()
-
-m485.modbus485_send(relay7_OFF)
-time.sleep(1)
-m485.modbus485_read()
-
-m485.modbus485_send(relay8_OFF)
-time.sleep(1)
-m485.modbus485_read()
+for i in range(1, 9):
+    print(list(m485.modbus485_transaction(relay_OFF[i], 8)))
 
 
 # Test soil temperature and moisture
-m485.modbus485_send(soil_temperature)
-time.sleep(1)
-# m485.modbus485_read()
-print(m485.modbus485_read_adc())
+out = m485.modbus485_transaction(soil_temperature, 7)
+print(out[3] * 256 + out[4])
 
-m485.modbus485_send(soil_moisture)
-time.sleep(1)
-# m485.modbus485_read()
-print(m485.modbus485_read_adc())
+out = m485.modbus485_transaction(soil_moisture, 7)
+print(out[3] * 256 + out[4])
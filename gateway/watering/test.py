@@ -3,7 +3,6 @@ import os
 import joblib
 import pandas as pd
 import tensorflow as tf
-from sklearn.metrics import accuracy_score
 
 
 class WateringPredictionModel:
@@ -27,13 +26,26 @@ class WateringPredictionModel:
         input_scaled = self.scaler.transform(input_df)
 
         # Make a prediction using the trained model
-        prediction = self.model.predict(input_scaled)
+        prediction = self.model.predict(input_scaled, verbose=0)
 
         # Convert prediction to a binary value (1 or 0)
         binary_prediction = 1 if prediction[0] >= 0.5 else 0
 
         return binary_prediction
 
+    def predict_batch(self, features):
+        """
+        Make predictions for many inputs with a single model call.
+        :param features: An array with one row of soil moisture, temperature and soil humidity per input.
+        :return: A boolean array, True where the prediction is "ON".
+        """
+        input_df = pd.DataFrame(
+            features, columns=["Soil Moisture", "Temperature", "Soil Humidity"]
+        )
+        input_scaled = self.scaler.transform(input_df)
+        predictions = self.model.predict(input_scaled, verbose=0)
+        return predictions[:, 0] >= 0.5
+
     def evaluate_model(self, X, y):
         """
         Evaluate the model on a given dataset.
@@ -50,6 +62,9 @@ class WateringPredictionModel:
         # Convert predictions to binary values (1 or 0)
         binary_predictions = [1 if pred >= 0.5 else 0 for pred in predictions]
 
+        # Only needed here, importing it slows down the gateway's startup
+        from sklearn.metrics import accuracy_score
+
         # Calculate accuracy
         accuracy = accuracy_score(y, binary_predictions)
 
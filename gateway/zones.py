@@ -0,0 +1,201 @@
+import numpy as np
+
+READINGS = ("temperature", "humidity", "moisture")
+
+ZONE_DTYPE = np.dtype(
+    [
+        ("temperature", "f8"),
+        ("humidity", "f8"),
+        ("moisture", "f8"),
+        ("watering", "?"),
+    ]
+)
+MIXER_DTYPE = np.dtype([("level", "i4"), ("on", "?")])
+
+DEFAULT_ZONES = ["area1", "area2", "area3"]
+DEFAULT_MIXERS = ["mixer1", "mixer2", "mixer3"]
+DEFAULT_PUMPS = {"in": "pumpin", "out": "pumpout"}
+
+
+class FarmState:
+    """
+    Readings and actuator flags of every zone, mixer and pump, one array
+    row per device so per-tick updates run across all zones at once.
+    """
+
+    def __init__(self, zones=None, mixers=None, pumps=None):
+        """
+        :param zones: Zone names, also their sensor and relay names.
+        :param mixers: Mixer tank names.
+        :param pumps: A dictionary with the names of the "in" and "out"
+            pumps.
+        """
+        self.zone_names = list(zones or DEFAULT_ZONES)
+        self.zone_index = {name: i for i, name in enumerate(self.zone_names)}
+        self.zones = np.zeros(len(self.zone_names), ZONE_DTYPE)
+
+        self.mixer_names = list(mixers or DEFAULT_MIXERS)
+        self.mixer_index = {name: i for i, name in enumerate(self.mixer_names)}
+        self.mixers = np.zeros(len(self.mixer_names), MIXER_DTYPE)
+
+        pumps = dict(DEFAULT_PUMPS, **(pumps or {}))
+        self.pump_in = pumps["in"]
+        self.pump_out = pumps["out"]
+        self.pump_names = [self.pump_in, self.pump_out]
+        self.pumps = np.zeros(2, "?")
+
+        self.water = 100
+        self.automatic = True
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: The "farm" section of config.json.
+        """
+        return cls(config.get("zones"), config.get("mixers"), config.get("pumps"))
+
+    def copy(self, readonly=False):
+        """
+        :param readonly: Make the arrays of the copy read-only, for
+            snapshots handed to other threads.
+        """
+        state = object.__new__(FarmState)
+        state.__dict__.update(self.__dict__)
+        state.zones = self.zones.copy()
+        state.mixers = self.mixers.copy()
+        state.pumps = self.pumps.copy()
+        if readonly:
+            for array in (state.zones, state.mixers, state.pumps):
+                array.flags.writeable = False
+        return state
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, FarmState)
+            and self.water == other.water
+            and self.automatic == other.automatic
+            and np.array_equal(self.zones, other.zones)
+            and np.array_equal(self.mixers, other.mixers)
+            and np.array_equal(self.pumps, other.pumps)
+        )
+
+    def set_readings(self, readings):
+        """
+        :param readings: A dictionary of zone -> {"temperature",
+            "humidity", "moisture"}, as returned by sweep_soil_data().
+            Unknown zones are ignored.
+        """
+        rows = [
+            (self.zone_index[zone], data)
+            for zone, data in readings.items()
+            if zone in self.zone_index
+        ]
+        if not rows:
+            return
+        index = np.fromiter((i for i, _ in rows), np.intp, len(rows))
+        for name in READINGS:
+            values = [data.get(name, np.nan) for _, data in rows]
+            column = self.zones[name]
+            # Keep the last value if a sensor left a reading out
+            column[index] = np.where(np.isnan(values), column[index], values)
+
+    def features(self):
+        """
+        :return: An array of moisture, temperature, humidity rows, the
+            watering model's input.
+        """
+        zones = self.zones
+        return np.column_stack(
+            (zones["moisture"], zones["temperature"], zones["humidity"])
+        )
+
+    def apply_flags(self, monitor):
+        """
+        Apply a message from the monitor feed, see monitor().
+        """
+        if "automatic" in monitor:
+            self.automatic = monitor["automatic"]
+        for zone, value in monitor.get("watering", {}).items():
+            if zone in self.zone_index:
+                self.zones["watering"][self.zone_index[zone]] = value
+        for mixer, value in monitor.get("mixer", {}).items():
+            if mixer in self.mixer_index:
+                self.mixers["on"][self.mixer_index[mixer]] = value
+        for pump, value in monitor.get("pump", {}).items():
+            if pump in self.pump_names:
+                self.pumps[self.pump_names.index(pump)] = value
+
+    def fill_mixers(self, targets, step=10):
+        """
+        Run one filling step for a task, mixers below their target level
+        are switched on and filled by step.
+        :param targets: A dictionary of mixer -> target level.
+        :return: The number of mixers that were filled.
+        """
+        index = np.array(
+            [self.mixer_index[mixer] for mixer in targets if mixer in self.mixer_index],
+            np.intp,
+        )
+        target = np.array(
+            [targets[mixer] for mixer in targets if mixer in self.mixer_index]
+        )
+        filling = target > self.mixers["level"][index]
+        self.mixers["level"][index[filling]] += step
+        self.mixers["on"][index] = filling
+        filled = int(np.count_nonzero(filling))
+        self.water -= filled
+        return filled
+
+    def set_pumps(self, pump_in, pump_out):
+        self.pumps[:] = (pump_in, pump_out)
+
+    def reset_mixers(self):
+        self.mixers["level"] = 0
+        self.mixers["on"] = False
+
+    def relay_states(self):
+        """
+        :return: A dictionary of relay name -> on, for RelayActuator.
+        """
+        return {
+            **dict(zip(self.zone_names, self.zones["watering"].tolist())),
+            **dict(zip(self.mixer_names, self.mixers["on"].tolist())),
+            **dict(zip(self.pump_names, self.pumps.tolist())),
+        }
+
+    def history_series(self):
+        """
+        :return: Names of the values in history_row().
+        """
+        return (
+            [f"{zone}.{name}" for zone in self.zone_names for name in READINGS]
+            + ["water"]
+            + [f"{mixer}.level" for mixer in self.mixer_names]
+        )
+
+    def history_row(self):
+        readings = np.column_stack([self.zones[name] for name in READINGS])
+        return np.concatenate((readings.ravel(), [self.water], self.mixers["level"]))
+
+    # The feed payloads, in the shape the frontend reads
+
+    def soil(self):
+        columns = [self.zones[name].tolist() for name in READINGS]
+        return {
+            zone: dict(zip(READINGS, values))
+            for zone, values in zip(self.zone_names, zip(*columns))
+        }
+
+    def level(self):
+        return {
+            "water": self.water,
+            **dict(zip(self.mixer_names, self.mixers["level"].tolist())),
+        }
+
+    def monitor(self):
+        return {
+            "automatic": self.automatic,
+            "watering": dict(zip(self.zone_names, self.zones["watering"].tolist())),
+            "mixer": dict(zip(self.mixer_names, self.mixers["on"].tolist())),
+            "pump": dict(zip(self.pump_names, self.pumps.tolist())),
+        }